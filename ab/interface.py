@@ -54,13 +54,10 @@ def _get_app_id(app_key):
 
 def get_confidence_data(experiment_id):
     SQL = """
-    SELECT
-        T.choice,
-        SUM(CASE WHEN T.goal_reached THEN 1 ELSE 0 END),
-        COUNT(1)
-    FROM ab_trial T
-    WHERE T.experiment_id = %s
-    GROUP BY T.choice
+    SELECT C.choice, SUM(C.successes), SUM(C.trials)
+    FROM ab_trialcount C
+    WHERE C.experiment_id = %s AND C.period = 'day'
+    GROUP BY C.choice
     """
     conn = _get_conn()
     cursor = conn.cursor()
@@ -98,37 +95,21 @@ def _cleanup_series(series, delta):
 
 def get_graphs(experiment_id):
     DAYS_SQL = """
-    SELECT ((
-        SELECT T1.date_started
-        FROM ab_trial T1
-        WHERE T1.experiment_id = %s
-        ORDER BY T1.date_started DESC
-        LIMIT 1
-    ) -
-    (
-        SELECT T2.date_started
-        FROM ab_trial T2
-        WHERE T2.experiment_id = %s
-        ORDER BY T2.date_started ASC
-        LIMIT 1
-    ))
+    SELECT MAX(C.timestamp) - MIN(C.timestamp)
+    FROM ab_trialcount C
+    WHERE C.experiment_id = %s AND C.period = 'hour'
     """
 
     SQL = """
-    SELECT
-        T.choice,
-        date_trunc('%(period)s', T.date_started),
-        COUNT(1),
-        SUM(CASE WHEN T.goal_reached THEN 1 else 0 END)
-    FROM ab_trial T
-    WHERE T.experiment_id = %%s
-    GROUP BY T.choice, date_trunc('%(period)s', T.date_started)
-    ORDER BY date_trunc('%(period)s', T.date_started)
+    SELECT C.choice, C.timestamp, C.trials, C.successes
+    FROM ab_trialcount C
+    WHERE C.experiment_id = %s AND C.period = %s
+    ORDER BY C.timestamp
     """
     conn = _get_conn()
     cursor = conn.cursor()
 
-    cursor.execute(DAYS_SQL, [experiment_id, experiment_id])
+    cursor.execute(DAYS_SQL, [experiment_id])
     resp = cursor.fetchone()
     if not resp:
         return {}
@@ -140,7 +121,7 @@ def get_graphs(experiment_id):
     else:
         period, delta = 'hour', datetime.timedelta(hours=1)
 
-    cursor.execute(SQL % {'period': period}, [experiment_id])
+    cursor.execute(SQL, [experiment_id, period])
     choice_series = defaultdict(lambda: {})
     for row in cursor.fetchall():
         choice_series[row[0]][row[1]] = {
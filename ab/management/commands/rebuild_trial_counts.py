@@ -0,0 +1,68 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+# Live increment_trial_counts calls wait for the rebuild instead of landing
+# between the DELETE and the INSERT, where they would be lost or counted twice.
+LOCK_SQL = """
+LOCK TABLE ab_trialcount IN EXCLUSIVE MODE
+"""
+
+DELETE_SQL = """
+DELETE FROM ab_trialcount %(where)s
+"""
+
+INSERT_SQL = """
+INSERT INTO ab_trialcount
+    (experiment_id, choice, period, timestamp, trials, successes)
+SELECT
+    T.experiment_id,
+    T.choice,
+    '%(period)s',
+    date_trunc('%(period)s', T.date_started AT TIME ZONE 'UTC')
+        AT TIME ZONE 'UTC',
+    COUNT(1),
+    SUM(CASE WHEN T.goal_reached THEN 1 ELSE 0 END)
+FROM ab_trial T
+%(where)s
+GROUP BY
+    T.experiment_id,
+    T.choice,
+    date_trunc('%(period)s', T.date_started AT TIME ZONE 'UTC')
+"""
+
+
+class Command(BaseCommand):
+    args = '[experiment_id ...]'
+    help = ('Recomputes the per-choice trial counts behind the experiment '
+        'pages from ab_trial, for the given experiments or for all of them.  '
+        'The experiment pages only read these counts, so when upgrading to '
+        'a version that keeps them, upgrade the RPC servers first and then '
+        'run this for all experiments before deploying the dashboard, or '
+        'existing experiments show no data.  It is safe to run while the RPC '
+        'servers are logging trials; they wait for it to finish.')
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        experiment_ids = tuple([int(arg) for arg in args])
+        where = 'WHERE experiment_id IN %s' if experiment_ids else ''
+        params = [experiment_ids] if experiment_ids else []
+        cursor = connection.cursor()
+        cursor.execute(LOCK_SQL)
+        cursor.execute(DELETE_SQL % {'where': where}, params)
+        for period in ('hour', 'day'):
+            cursor.execute(INSERT_SQL % {'where': where, 'period': period},
+                params)
@@ -63,6 +63,18 @@ class Trial(models.Model):
         unique_together = (('udid', 'experiment_id'),)
 
 
+class TrialCount(models.Model):
+    experiment_id = models.PositiveIntegerField()
+    choice = models.IntegerField()
+    period = models.CharField(max_length=5)
+    timestamp = models.DateTimeField()
+    trials = models.IntegerField(default=0)
+    successes = models.IntegerField(default=0)
+
+    class Meta(object):
+        unique_together = (('experiment_id', 'choice', 'period', 'timestamp'),)
+
+
 class UniqueMonth(models.Model):
     uuid = models.CharField(max_length=62, primary_key=True, unique=True,
         default=lambda: str(uuid.uuid1()))
@@ -15,11 +15,16 @@
 import simplejson
 
 from clutchrpc import db
+from clutchrpc import limits
+from clutchrpc import spool
 from clutchrpc import utils
 
 
 def send_ab_logs(request_json, logs, guid):
-    db.add_bulk_ab_logs(
+    problem = db.check_ab_logs(logs)
+    if problem is not None:
+        return utils.jsonrpc_error(request_json, 21, {'problem': problem})
+    args = [
         guid.replace('-', ''),
         request_json['_api_version'],
         request_json['_app_version'],
@@ -27,12 +32,15 @@ def send_ab_logs(request_json, logs, guid):
         request_json['_app_key'],
         request_json['_platform'],
         logs
-    )
+    ]
+    if not spool.append('ab', args):
+        with limits.bulk():
+            db.add_bulk_ab_logs(*args)
     return utils.jsonrpc_response(request_json, {'status': 'ok'})
 
 
 def get_ab_metadata(request_json, guid):
-    app = db.get_app_from_key(request_json['_app_key'])
+    app = db.get_app_for_request(request_json)
     if app is None:
         data = {'app_key': request_json['_app_key']}
         return utils.jsonrpc_error(request_json, 8, data)
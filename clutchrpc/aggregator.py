@@ -0,0 +1,212 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+
+import gevent
+
+from clutchrpc import utils
+
+
+class CounterAggregator(object):
+    """
+    Buffers increments to rollup counter tables in memory and writes them out
+    in bulk, either every ``interval`` seconds or as soon as ``max_keys``
+    distinct rows are pending, whichever comes first.
+
+    ``flush_func`` is called as ``flush_func(table, columns, counts)`` where
+    ``counts`` maps a tuple of values for ``columns`` to an increment.  If it
+    fails, the increments are put back and retried on the next flush, unless
+    more than ``max_pending`` rows are already waiting, in which case they
+    are dropped and counted as lost.
+    """
+
+    def __init__(self, flush_func, interval=5, max_keys=1000,
+        max_pending=100000):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_keys = max_keys
+        self.max_pending = max_pending
+        self.columns = {}
+        self.pending = defaultdict(lambda: defaultdict(int))
+        self.num_keys = 0
+        self.greenlet = None
+        self.flushing = False
+        self.counters = {
+            'pending': 0,
+            'flushed': 0,
+            'deferred': 0,
+            'lost': 0,
+        }
+
+    def add(self, table, columns, counts):
+        """
+        Queues the increments in ``counts`` for the given table.
+        """
+        self.columns[table] = columns
+        pending = self.pending[table]
+        for key, value in counts.iteritems():
+            if key not in pending:
+                self.num_keys += 1
+            pending[key] += value
+            self.counters['pending'] += value
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self._run)
+        if self.num_keys >= self.max_keys and not self.flushing:
+            gevent.spawn(self.flush)
+
+    def flush(self):
+        """
+        Writes out everything that is currently buffered.
+        """
+        if self.flushing:
+            return
+        self.flushing = True
+        try:
+            pending, self.pending = self.pending, defaultdict(
+                lambda: defaultdict(int))
+            self.num_keys = 0
+            for table, counts in pending.iteritems():
+                total = sum(counts.itervalues())
+                self.counters['pending'] -= total
+                try:
+                    self.flush_func(table, self.columns[table], counts)
+                except Exception:
+                    utils.exception_printer(None)
+                    self._requeue(table, counts, total)
+                else:
+                    self.counters['flushed'] += total
+        finally:
+            self.flushing = False
+
+    def _requeue(self, table, counts, total):
+        if self.num_keys + len(counts) > self.max_pending:
+            self.counters['lost'] += total
+            return
+        self.counters['deferred'] += total
+        self.add(table, self.columns[table], counts)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+
+    def stop(self):
+        """
+        Stops the periodic flushing and writes out anything still buffered.
+        """
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        while self.flushing:
+            gevent.sleep(0.1)
+        self.flush()
+
+
+class SketchAggregator(object):
+    """
+    Buffers additions to unique user sketches in memory, as the largest rank
+    seen for each register, and merges them into the stored sketches either
+    every ``interval`` seconds or as soon as ``max_keys`` sketches are
+    pending, whichever comes first.  That way each stored sketch is written
+    once per flush rather than once per stats batch.
+
+    ``flush_func`` is called as ``flush_func(sketches)`` where ``sketches``
+    maps a sketch's key to a pair of dictionaries, for all users and for new
+    users, mapping register indexes to ranks.  If it fails, the registers are
+    put back and retried on the next flush, unless more than ``max_pending``
+    sketches are already waiting, in which case they are dropped and counted
+    as lost.
+    """
+
+    def __init__(self, flush_func, interval=5, max_keys=1000,
+        max_pending=100000):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_keys = max_keys
+        self.max_pending = max_pending
+        self.pending = {}
+        self.greenlet = None
+        self.flushing = False
+        self.counters = {
+            'pending': 0,
+            'flushed': 0,
+            'deferred': 0,
+            'lost': 0,
+        }
+
+    def _merge(self, key, registers, new_registers):
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = ({}, {})
+            self.counters['pending'] += 1
+        for current, updates in zip(pending, (registers, new_registers)):
+            for index, rank in updates.iteritems():
+                if rank > current.get(index, 0):
+                    current[index] = rank
+
+    def add(self, key, index, rank, new):
+        """
+        Sets the register at ``index`` of the sketch for ``key`` to at least
+        ``rank``, and likewise for its new users if ``new`` is true.
+        """
+        self._merge(key, {index: rank}, {index: rank} if new else {})
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self._run)
+        if len(self.pending) >= self.max_keys and not self.flushing:
+            gevent.spawn(self.flush)
+
+    def flush(self):
+        """
+        Writes out everything that is currently buffered.
+        """
+        if self.flushing or not self.pending:
+            return
+        self.flushing = True
+        try:
+            pending, self.pending = self.pending, {}
+            self.counters['pending'] -= len(pending)
+            try:
+                self.flush_func(pending)
+            except Exception:
+                utils.exception_printer(None)
+                self._requeue(pending)
+            else:
+                self.counters['flushed'] += len(pending)
+        finally:
+            self.flushing = False
+
+    def _requeue(self, pending):
+        if len(self.pending) + len(pending) > self.max_pending:
+            self.counters['lost'] += len(pending)
+            return
+        self.counters['deferred'] += len(pending)
+        for key, (registers, new_registers) in pending.iteritems():
+            self._merge(key, registers, new_registers)
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.flush()
+
+    def stop(self):
+        """
+        Stops the periodic flushing and writes out anything still buffered.
+        """
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+        while self.flushing:
+            gevent.sleep(0.1)
+        self.flush()
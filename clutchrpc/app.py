@@ -19,14 +19,15 @@ import cgi
 import contextlib
 import hashlib
 import importlib
-import os
-import shutil
-import tempfile
+import mimetypes
+import signal
+import time
 import zipfile
+import zlib
 
-from StringIO import StringIO
+import gevent
 
-from boto.s3.connection import S3Connection
+from gevent.pool import Pool
 
 import simplejson
 
@@ -34,6 +35,32 @@ from clutch import settings
 
 from clutchrpc import utils
 from clutchrpc import db
+from clutchrpc import framework
+from clutchrpc import limits
+from clutchrpc import listener as key_listener
+from clutchrpc import metrics
+from clutchrpc import spool
+from clutchrpc import storage
+
+# How many files of an uploaded archive to write to storage at once
+UPLOAD_CONCURRENCY = getattr(settings, 'CLUTCH_RPC_UPLOAD_CONCURRENCY', 10)
+
+# How many calls in a JSON-RPC batch to run at once, and how many a batch may
+# hold at most.
+BATCH_CONCURRENCY = getattr(settings, 'CLUTCH_RPC_BATCH_CONCURRENCY', 10)
+MAX_BATCH_SIZE = getattr(settings, 'CLUTCH_RPC_MAX_BATCH_SIZE', 100)
+
+# The largest that a gzipped request body may be once decompressed
+MAX_REQUEST_SIZE = getattr(settings, 'CLUTCH_RPC_MAX_REQUEST_SIZE',
+    32 * 1024 * 1024)
+
+# Whether to serve metrics at /metrics, which anyone who can reach the RPC
+# server can read.
+METRICS_ENABLED = getattr(settings, 'CLUTCH_RPC_METRICS', False)
+
+# Whether to build the archive that get_bundle serves as soon as a version is
+# uploaded, rather than when a device first asks for it.
+BUILD_BUNDLES = getattr(settings, 'CLUTCH_RPC_BUILD_BUNDLES', False)
 
 
 METHODS = {}
@@ -52,6 +79,82 @@ def responder(func):
     return _inner
 
 
+def _busy(request_json, method, start):
+    resp = utils.jsonrpc_error(request_json, 18, {'method': method,
+        'retry_after': limits.RETRY_AFTER}, code=503)
+    resp.headers = [('Retry-After', str(limits.RETRY_AFTER))]
+    resp.payload['error']['retry_after'] = limits.RETRY_AFTER
+    metrics.record_call(method, time.time() - start, 18)
+    return resp
+
+
+def call_method(request_json):
+    method = request_json.get('method')
+    if not method:
+        return utils.jsonrpc_error(request_json, 1, {'method': method})
+    func = METHODS.get(method)
+    if func is None:
+        return utils.jsonrpc_error(request_json, 12, {'method': method})
+    start = time.time()
+    limiter = limits.acquire(method)
+    if limiter is None:
+        return _busy(request_json, method, start)
+    try:
+        resp = func(request_json, **(request_json.get('params') or {}))
+    except limits.Busy:
+        return _busy(request_json, method, start)
+    except Exception, e:
+        utils.exception_printer(None)
+        resp = utils.jsonrpc_error(request_json, 3, {'detail': str(e)})
+    finally:
+        limits.release(limiter)
+    error = getattr(resp, 'payload', None) and resp.payload['error']
+    if error:
+        metrics.record_call(method, time.time() - start, error['code'],
+            error['detail'])
+    else:
+        metrics.record_call(method, time.time() - start)
+    return resp
+
+
+def _get_batch_payload(request_json, resp):
+    if isinstance(resp, utils.ResponseRedirect):
+        return {'id': request_json.get('id'), 'error': None,
+            'result': {'url': resp.data}}
+    if isinstance(resp, utils.JSONResponse):
+        return resp.payload
+    return simplejson.loads(resp.data)
+
+
+def call_batch(calls, headers):
+    """
+    Makes a batch of calls concurrently, all with the same headers and the
+    same app, and returns a response listing their results in order.
+    """
+    # Look the app up once, before the calls race to do it themselves
+    if headers['_app_key']:
+        db.get_app_for_request(headers)
+    calls = [c if isinstance(c, dict) else {} for c in calls]
+    pool = Pool(BATCH_CONCURRENCY)
+    greenlets = []
+    for request_json in calls:
+        request_json.update(headers)
+        greenlets.append(pool.spawn(call_method, request_json))
+    pool.join()
+    payloads = []
+    for call, greenlet in zip(calls, greenlets):
+        # A greenlet that was killed counts as successful, with the
+        # GreenletExit as its value
+        if greenlet.successful() and isinstance(greenlet.value,
+                utils.Response):
+            payloads.append(_get_batch_payload(call, greenlet.value))
+        else:
+            detail = greenlet.exception or greenlet.value
+            payloads.append(utils.jsonrpc_error(call, 3,
+                {'detail': repr(detail)}).payload)
+    return utils.render_json(payloads)
+
+
 @responder
 def handle_rpc(env, start_response):
     try:
@@ -62,8 +165,22 @@ def handle_rpc(env, start_response):
         raw_data = env['wsgi.input'].read(content_length)
     else:
         raw_data = env['wsgi.input'].read()
-    request_json = simplejson.loads(raw_data)
-    request_json.update({
+    if env.get('HTTP_CONTENT_ENCODING', '').lower() == 'gzip':
+        try:
+            raw_data = utils.gunzip(raw_data, MAX_REQUEST_SIZE)
+        except utils.RequestTooLarge:
+            return utils.jsonrpc_error({}, 20, {'max_size': MAX_REQUEST_SIZE},
+                code=413)
+        except zlib.error, e:
+            return utils.jsonrpc_error({}, 19,
+                {'reason': 'invalid gzip body (%s)' % (e,)}, code=400)
+    try:
+        request_json = utils.get_request_codec(env).loads(raw_data)
+    except ValueError, e:
+        # Such as a truncated gzip body, which zlib decompresses silently
+        return utils.jsonrpc_error({}, 19,
+            {'reason': 'undecodable body (%s)' % (e,)}, code=400)
+    headers = {
         '_app_key': env.get('HTTP_X_APP_KEY'),
         '_udid': env.get('HTTP_X_UDID'),
         '_api_version': env.get('HTTP_X_API_VERSION'),
@@ -72,19 +189,35 @@ def handle_rpc(env, start_response):
         '_clutch_username': env.get('HTTP_X_CLUTCH_USERNAME'),
         '_clutch_password': env.get('HTTP_X_CLUTCH_PASSWORD'),
         '_platform': env.get('HTTP_X_PLATFORM', 'iOS'),
-    })
-    method = request_json.get('method')
-    if not method:
-        return utils.jsonrpc_error(request_json, 1, {'method': method})
-    func = METHODS.get(method)
-    if func is None:
-        return utils.jsonrpc_error(request_json, 12, {'method': method})
-    print method, raw_data[:100]
-    try:
-        return func(request_json, **(request_json.get('params') or {}))
-    except Exception, e:
-        utils.exception_printer(None)
-        return utils.jsonrpc_error(request_json, 3, {'detail': str(e)})
+        '_context': {},
+    }
+    if isinstance(request_json, list):
+        if not request_json:
+            return utils.jsonrpc_error({}, 19, {'reason': 'empty batch'})
+        if len(request_json) > MAX_BATCH_SIZE:
+            return utils.jsonrpc_error({}, 17, {'size': len(request_json),
+                'max_size': MAX_BATCH_SIZE})
+        return call_batch(request_json, headers)
+    request_json.update(headers)
+    return call_method(request_json)
+
+
+def _get_stored_objects(app_slug, app_version):
+    """
+    Returns the set of hashes that the given version's files are stored
+    under, which is empty unless it was stored by content.
+    """
+    index = storage.get(storage.get_index_name(app_slug, app_version))
+    if index is None:
+        return set()
+    return set(simplejson.loads(index).itervalues())
+
+
+def _put_object(app_slug, digest, data, content_type):
+    # Earlier versions may have stored the same contents already
+    name = storage.get_object_name(app_slug, digest)
+    if not storage.exists(name):
+        storage.put(name, data, content_type, immutable=True)
 
 
 @responder
@@ -115,50 +248,66 @@ def handle_upload(env, start_response):
     else:
         app_version += 1
 
-    tmp = StringIO(form['archive'].file.read())
-    extracted = tempfile.mkdtemp()
+    # cgi has already spooled the archive to a temporary file, which zipfile
+    # can read the members from one at a time.
     zip_context = contextlib.closing(
-        zipfile.ZipFile(tmp, 'r', zipfile.ZIP_DEFLATED))
+        zipfile.ZipFile(form['archive'].file, 'r', zipfile.ZIP_DEFLATED))
     with zip_context as z:
-        namelist = z.namelist()
+        namelist = [n for n in z.namelist() if not n.endswith('/')]
         for name in namelist:
-            if name.startswith('..'):
+            if name.startswith('..') or '..' in name.split('/'):
                 return utils.jsonrpc_error({}, 6, {'name': name})
             if name.startswith('/'):
                 return utils.jsonrpc_error({}, 6, {'name': name})
-        z.extractall(extracted)
-
-    # Get rid of the StringIO for memory savings
-    del tmp
-
-    # Now we upload that to S3
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_ACCESS_SECRET)
-    bucket = conn.get_bucket(settings.AWS_BUCKET_NAME)
-    for name in namelist:
-        upload_fn = '%s/%s/files/%s' % (app_slug, app_version, name)
-        key = bucket.new_key(upload_fn)
-        key.set_contents_from_filename(os.path.join(extracted, name))
-
-    # Generate an md5 hash of each file in the upload
-    hashes = {}
-    for name in namelist:
-        with open(os.path.join(extracted, name), 'r') as f:
-            hashes[name] = hashlib.md5(f.read()).hexdigest()
-
-    # JSON-encode the md5 hashes and upload them to s3
+
+        # Hash each file as it is read, and upload it in the background
+        # while the next one is read.  The pool bounds how many files are
+        # held in memory at once.
+        pool = Pool(UPLOAD_CONCURRENCY)
+        greenlets = []
+        hashes = {}
+        stored = set()
+        if storage.CONTENT_ADDRESSED:
+            stored = _get_stored_objects(app_slug, app_version - 1)
+        for name in namelist:
+            data = z.read(name)
+            digest = hashlib.md5(data).hexdigest()
+            hashes[name] = digest
+            if not storage.CONTENT_ADDRESSED:
+                upload_fn = '%s/%s/files/%s' % (app_slug, app_version, name)
+                greenlets.append(pool.spawn(storage.put, upload_fn, data,
+                    immutable=True))
+            elif digest not in stored:
+                stored.add(digest)
+                greenlets.append(pool.spawn(_put_object, app_slug, digest,
+                    data, mimetypes.guess_type(name)[0]))
+        pool.join()
+        for greenlet in greenlets:
+            if not greenlet.successful():
+                raise greenlet.exception
+
+    # JSON-encode the md5 hashes and upload them to storage
     manifest = simplejson.dumps(hashes)
+    if storage.CONTENT_ADDRESSED:
+        storage.put(storage.get_index_name(app_slug, app_version), manifest)
     manifest_key = '%s/%s/meta/manifest.json' % (app_slug, app_version)
-    key = bucket.new_key(manifest_key)
-    key.set_contents_from_string(manifest)
-
-    # Delete the temporary directory
-    shutil.rmtree(extracted)
+    storage.put(manifest_key, manifest)
 
     db.create_app_version(app['id'], app_version)
 
+    if BUILD_BUNDLES:
+        framework.start_bundle_build(app_slug, app_version)
+
     return utils.jsonrpc_response({}, {'version': app_version})
 
 
+def handle_metrics(env, start_response):
+    start_response('200 OK', [
+        ('Content-Type', 'text/plain; version=0.0.4'),
+    ])
+    return [metrics.render()]
+
+
 @responder
 def handle_404(env, start_response):
     start_response('404 Not Found', [('Content-Type', 'text/plain')])
@@ -171,13 +320,28 @@ def app(env, start_response):
         return handle_rpc(env, start_response)
     elif path == '/rpc/upload/':
         return handle_upload(env, start_response)
+    elif path == '/metrics' and METRICS_ENABLED:
+        return handle_metrics(env, start_response)
     return handle_404(env, start_response)
 
 
 def serve_forever(listener, host, port):
     from gevent.pywsgi import WSGIServer
     print 'Starting clutchrpc on %s:%s ...' % (host, port)
-    WSGIServer(listener, app).serve_forever()
+    server = WSGIServer(listener, app)
+    gevent.signal(signal.SIGTERM, server.stop)
+    key_listener.start()
+    metrics.start()
+    spool.start()
+    try:
+        server.serve_forever()
+    finally:
+        key_listener.stop()
+        metrics.stop()
+        spool.stop()
+        # Write out any counters and sketches still buffered in memory
+        db.view_aggregator.stop()
+        db.sketch_aggregator.stop()
 
 
 def main():
@@ -0,0 +1,164 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmarks for the hot paths of the RPC server.  Run one with, e.g.:
+
+    CLUTCH_CONF=/path/to/clutch.conf python -m clutchrpc.bench goals
+
+The ``goals`` benchmark writes to the configured database, using a device id
+and experiment ids that no real client will ever send, and removes its rows
+again when it is done.
+
+The ``codecs`` benchmark times decoding and encoding with every wire format
+that is installed.  It takes the paths of recorded request or response
+bodies in JSON as arguments, and makes up a stats request and a sync response
+of typical size if there are none.
+"""
+
+import json
+import sys
+import time
+import uuid
+
+import simplejson
+
+from clutchrpc import db
+from clutchrpc import utils
+
+BENCH_UDID = 'clutchrpc-bench'
+
+# Well above any real experiment id
+BENCH_EXPERIMENT_ID = 2000000000
+
+
+def _timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def _complete_serially(goals):
+    # How goals were applied before complete_trials: one round trip each
+    for udid, experiment_id, dt in goals:
+        db.db.execute("""
+        UPDATE ab_trial SET date_completed = %s, goal_reached = TRUE
+        WHERE udid = %s AND experiment_id = %s
+        """, (dt, udid, experiment_id))
+
+
+def bench_goals(size=500):
+    """
+    Times attributing a batch of ``size`` goals to their trials one statement
+    at a time against doing it with complete_trials.
+    """
+    started = utils.get_now()
+    experiment_ids = range(BENCH_EXPERIMENT_ID, BENCH_EXPERIMENT_ID + size)
+    trials = [(str(uuid.uuid1()), BENCH_UDID, 0, experiment_id, started,
+        started, 1) for experiment_id in experiment_ids]
+    goals = [(BENCH_UDID, experiment_id, utils.get_now())
+        for experiment_id in experiment_ids]
+    # A few goals for trials that don't exist, as happens in real batches
+    goals.extend([(BENCH_UDID, BENCH_EXPERIMENT_ID + size + i,
+        utils.get_now()) for i in xrange(size // 50)])
+
+    results = []
+    try:
+        for name, func in (('serial', _complete_serially),
+                ('set-based', db.complete_trials)):
+            db.db.execute('DELETE FROM ab_trial WHERE udid = %s',
+                (BENCH_UDID,))
+            db.insert_trials(trials)
+            results.append((name, _timed(func, goals)))
+    finally:
+        db.db.execute('DELETE FROM ab_trial WHERE udid = %s', (BENCH_UDID,))
+
+    for name, elapsed in results:
+        print '%-10s %4d goals in %8.2fms' % (name, len(goals),
+            elapsed * 1000)
+    print 'unmatched goals: %(unmatched)d of %(goals)d' % db.goal_counters
+
+
+def _get_codecs():
+    codecs = [
+        utils.Codec('simplejson', 'application/json', simplejson.loads,
+            simplejson.dumps),
+        utils.Codec('json', 'application/json', json.loads, json.dumps),
+    ]
+    if utils.JSON.name == 'ujson':
+        codecs.append(utils.JSON)
+    if utils.msgpack is not None:
+        codecs.append(utils.MSGPACK)
+    return codecs
+
+
+def _make_payloads():
+    now = time.time()
+    stats = {'method': 'stats', 'id': 1, 'params': {'logs': [{
+        'uuid': str(uuid.uuid1()),
+        'ts': now + i * 0.25,
+        'action': 'viewDidAppear' if i % 2 else 'viewDidDisappear',
+        'data': {'slug': 'screen%d' % (i % 20,)},
+    } for i in xrange(500)]}}
+    sync = {'id': 1, 'error': None, 'result': {
+        'files': dict(('assets/img%04d.png' % (i,),
+            uuid.uuid4().hex) for i in xrange(2000)),
+        'conf': {'_version': 12, '_dev': False, '_toolbar': False,
+            '_url': 'http://127.0.0.1:41675/', '_timestamps': []},
+    }}
+    return [('stats', stats), ('sync', sync)]
+
+
+def bench_codecs(*paths, **kwargs):
+    """
+    Times decoding and encoding each payload with each installed codec.
+    """
+    rounds = kwargs.get('rounds', 100)
+    payloads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            payloads.append((path, simplejson.load(f)))
+    if not payloads:
+        payloads = _make_payloads()
+
+    print 'picked %s for JSON' % (utils.JSON.name,)
+    for name, payload in payloads:
+        for codec in _get_codecs():
+            data = codec.dumps(payload)
+            encode = _timed(lambda: [codec.dumps(payload)
+                for i in xrange(rounds)])
+            decode = _timed(lambda: [codec.loads(data)
+                for i in xrange(rounds)])
+            print '%-10s %-10s %8d bytes %8.3fms decode %8.3fms encode' % (
+                name, codec.name, len(data), decode * 1000 / rounds,
+                encode * 1000 / rounds)
+
+
+BENCHMARKS = {
+    'goals': bench_goals,
+    'codecs': bench_codecs,
+}
+
+
+def main(args):
+    if not args or args[0] not in BENCHMARKS:
+        print 'usage: python -m clutchrpc.bench <%s> [args]' % (
+            '|'.join(sorted(BENCHMARKS)),)
+        return 1
+    BENCHMARKS[args[0]](*args[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
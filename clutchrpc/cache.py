@@ -0,0 +1,261 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import time
+
+from gevent.event import AsyncResult
+
+_MISSING = object()
+
+
+class GenerationalSet(object):
+    """
+    A set that holds at most about ``max_size`` items.
+
+    Items are added to the current generation, and once that holds half of
+    ``max_size`` items it becomes the previous generation and the old
+    previous generation is thrown away.  Items found in the previous
+    generation are moved back into the current one, so recently used items
+    survive while memory stays bounded.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.current = set()
+        self.previous = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, item):
+        if item in self.current:
+            self.hits += 1
+            return True
+        if item in self.previous:
+            self.hits += 1
+            self.add(item)
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, item):
+        if len(self.current) >= self.max_size / 2:
+            self.previous, self.current = self.current, set()
+        self.current.add(item)
+
+    def clear(self):
+        self.current = set()
+        self.previous = set()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.current) + len(self.previous),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+
+class GenerationalDict(object):
+    """
+    A dictionary that holds at most about ``max_size`` items, evicting the
+    least recently used ones in the same way as ``GenerationalSet``.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.current = {}
+        self.previous = {}
+
+    def get(self, key, default=None):
+        if key in self.current:
+            return self.current[key]
+        if key in self.previous:
+            value = self.previous.pop(key)
+            self.set(key, value)
+            return value
+        return default
+
+    def set(self, key, value):
+        if key not in self.current and len(self.current) >= self.max_size / 2:
+            self.previous, self.current = self.current, {}
+        self.current[key] = value
+
+    def clear(self):
+        self.current = {}
+        self.previous = {}
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+
+class TTLCache(object):
+    """
+    A mapping whose entries expire ``ttl`` seconds after they were set, or
+    after the ``ttl`` given to ``set`` for that entry.
+
+    Holds at most ``max_size`` entries: when it fills up, expired entries are
+    dropped first, and everything else too if that doesn't free any room.
+    ``generation`` changes whenever entries are removed, so that a caller can
+    avoid caching a value it looked up before an invalidation raced it.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.entries.pop(key, None)
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl=None, generation=None):
+        if generation is not None and generation != self.generation:
+            return
+        if key not in self.entries and len(self.entries) >= self.max_size:
+            now = time.time()
+            for k, entry in self.entries.items():
+                if entry[0] <= now:
+                    del self.entries[k]
+            if len(self.entries) >= self.max_size:
+                self.entries = {}
+        if ttl is None:
+            ttl = self.ttl
+        self.entries[key] = (time.time() + ttl, value)
+
+    def delete(self, key):
+        self.generation += 1
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries = {}
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
+
+
+class ImmutableCache(object):
+    """
+    Caches values that never change once they exist, such as the files of an
+    app version that has been uploaded.
+
+    Values are kept in an in-process ``GenerationalDict`` in front of an
+    optional shared Django cache backend, so that a value fetched by one
+    process is reused by the others.  Concurrent misses for the same key wait
+    on a single call to the fetch function rather than each making their own.
+    Callers must not modify the values they get back.
+
+    The fetch function returns None for a value that doesn't exist yet, such
+    as the manifest of a version that is still being uploaded.  That is only
+    remembered in this process, for ``negative_ttl`` seconds, so that asking
+    for something that doesn't exist over and over can't hammer the fetch
+    function, and a value that appears later is picked up soon after.
+    """
+
+    # Most memcached servers treat anything longer as an absolute timestamp
+    SHARED_TIMEOUT = 30 * 24 * 60 * 60
+
+    def __init__(self, max_size, shared=None, prefix='', negative_ttl=0):
+        self.local = GenerationalDict(max_size)
+        self.shared = shared
+        self.prefix = prefix
+        self.negative_ttl = negative_ttl
+        self.missing = TTLCache(max_size, negative_ttl)
+        self.pending = {}
+        self.counters = {
+            'local_hits': 0,
+            'shared_hits': 0,
+            'negative_hits': 0,
+            'misses': 0,
+            'waits': 0,
+        }
+
+    def _get_shared_key(self, key):
+        return self.prefix + hashlib.sha1(repr(key)).hexdigest()
+
+    def get(self, key, fetch, *args):
+        """
+        Returns the value for ``key``, calling ``fetch(*args)`` to produce it
+        if it isn't cached anywhere yet.
+        """
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            self.counters['local_hits'] += 1
+            return value
+        if self.missing.get(key, False):
+            self.counters['negative_hits'] += 1
+            return None
+        pending = self.pending.get(key)
+        if pending is not None:
+            self.counters['waits'] += 1
+            return pending.get()
+        pending = self.pending[key] = AsyncResult()
+        try:
+            value = self._load(key, fetch, args)
+        except Exception, e:
+            pending.set_exception(e)
+            raise
+        else:
+            pending.set(value)
+            return value
+        finally:
+            del self.pending[key]
+
+    def _load(self, key, fetch, args):
+        shared_key = self._get_shared_key(key)
+        if self.shared is not None:
+            value = self.shared.get(shared_key, _MISSING)
+            if value is not _MISSING:
+                self.counters['shared_hits'] += 1
+                self.local.set(key, value)
+                return value
+        self.counters['misses'] += 1
+        value = fetch(*args)
+        if value is None:
+            if self.negative_ttl:
+                self.missing.set(key, True)
+            return None
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(shared_key, value, self.SHARED_TIMEOUT)
+        return value
+
+    def stats(self):
+        total = sum(self.counters.values())
+        hits = (self.counters['local_hits'] + self.counters['shared_hits'] +
+            self.counters['negative_hits'])
+        return dict(self.counters, **{
+            'size': len(self.local),
+            'max_size': self.local.max_size,
+            'hit_rate': float(hits) / total if total else 0.0,
+        })
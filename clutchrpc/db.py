@@ -14,29 +14,116 @@
 
 import datetime
 import os
+import random
 import uuid
 
+from collections import defaultdict
+
+import gevent
 import psycopg2
+import psycopg2.errorcodes
+import psycopg2.extensions
 import pytz
 import simplejson
 
+from gevent.event import AsyncResult
 from gevent.pool import Pool
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'clutch.settings')
 from django.contrib.auth.hashers import check_password
 
+from clutch import settings
+
 from clutchrpc import utils
+from clutchrpc.aggregator import CounterAggregator, SketchAggregator
+from clutchrpc.cache import GenerationalSet, TTLCache
 from clutchrpc.pg2 import db
 
+from stats import hll
+from stats import partitions
+
+# When set, raw logs are inserted directly into the monthly partitions created
+# by the partition_logs management command.
+LOG_PARTITIONS = getattr(settings, 'CLUTCH_LOG_PARTITIONS', False)
+
+# When set, unique users are counted with HyperLogLog sketches in
+# stats_uniquesketch instead of one stats_unique* row per user and bucket.
+STATS_UNIQUE_SKETCHES = getattr(settings, 'STATS_UNIQUE_SKETCHES', False)
+
+# How many seconds to merge additions to those sketches in memory for before
+# writing them out, so that each sketch is written once per interval.
+SKETCH_FLUSH_INTERVAL = getattr(settings, 'CLUTCH_RPC_SKETCH_FLUSH_INTERVAL',
+    5)
+
+# How many statements one stats or A/B batch may run at once alongside the
+# greenlet ingesting it, so that a batch holds at most this many database
+# connections plus one.
+INGEST_CONCURRENCY = getattr(settings, 'CLUTCH_RPC_INGEST_CONCURRENCY', 2)
+
+# How many (app_id, udid, platform) keys of devices already recorded in
+# stats_uniquealltime to remember, at roughly 200 bytes each.
+KNOWN_DEVICES_MAX_SIZE = getattr(settings, 'CLUTCH_RPC_KNOWN_DEVICES_MAX_SIZE',
+    500000)
+
+# When set, view counter increments are buffered in-process and written out
+# every this many seconds instead of once per stats batch.
+VIEW_FLUSH_INTERVAL = getattr(settings, 'CLUTCH_RPC_VIEW_FLUSH_INTERVAL', None)
+VIEW_FLUSH_MAX_KEYS = getattr(settings, 'CLUTCH_RPC_VIEW_FLUSH_MAX_KEYS', 1000)
+
+# How many seconds to remember which app an app key belongs to, and that a key
+# is unknown or inactive.  Key changes made through the dashboard are pushed
+# to every server by clutchrpc.listener, so these only bound how stale the
+# cache can get when a notification is missed.
+APP_KEY_CACHE_TTL = getattr(settings, 'CLUTCH_RPC_APP_KEY_CACHE_TTL', 300)
+APP_KEY_CACHE_NEGATIVE_TTL = getattr(settings,
+    'CLUTCH_RPC_APP_KEY_CACHE_NEGATIVE_TTL', 30)
+APP_KEY_CACHE_MAX_SIZE = getattr(settings, 'CLUTCH_RPC_APP_KEY_CACHE_MAX_SIZE',
+    10000)
+
+
+app_keys = TTLCache(APP_KEY_CACHE_MAX_SIZE, APP_KEY_CACHE_TTL)
+
+_MISSING = object()
+
 
 def get_app_from_key(key):
+    app = app_keys.get(key, _MISSING)
+    if app is not _MISSING:
+        return app
     SQL = """
     SELECT A.*
     FROM dashboard_app A
     LEFT JOIN dashboard_appkey K ON (K.app_id = A.id)
     WHERE K.key = %s AND K.status = 'active'
     """
-    return db.fetchone(SQL, [key])
+    generation = app_keys.generation
+    app = db.fetchone(SQL, [key])
+    app_keys.set(key, app, generation=generation,
+        ttl=None if app else APP_KEY_CACHE_NEGATIVE_TTL)
+    return app
+
+
+def get_app_for_request(request_json):
+    """
+    Returns the app for the app key of an RPC call, which is only looked up
+    once for all of the calls in a batch.
+    """
+    context = request_json.get('_context')
+    if context is None:
+        return get_app_from_key(request_json['_app_key'])
+    if 'app' not in context:
+        context['app'] = get_app_from_key(request_json['_app_key'])
+    return context['app']
+
+
+def invalidate_app_key(key=None):
+    """
+    Forgets what is cached about the given app key, or about every key.
+    """
+    if key is None:
+        app_keys.clear()
+    else:
+        app_keys.delete(key)
 
 
 def get_user_from_creds(username, password):
@@ -79,6 +166,15 @@ def get_latest_app_version(app_id):
     return resp['version']
 
 
+def app_version_exists(app_id, app_version):
+    SQL = """
+    SELECT 1
+    FROM dashboard_version V
+    WHERE V.app_id = %s AND V.version = %s
+    """
+    return db.fetchone(SQL, [app_id, app_version]) is not None
+
+
 def get_app_version_for_bundle_version(app_id, bundle_version):
     SQL = """
     SELECT V.version
@@ -192,169 +288,652 @@ def get_variations_for_app(app_id):
     return db.fetchall(SQL, [app_id])
 
 
-def add_bulk_stats_logs(udid, api_version, app_version, bundle_version,
-    app_key, platform, logs):
+ROLLUP_PERIODS = ('hour', 'day', 'month', 'year')
+
+
+def _get_buckets(ts):
     """
-    Adds bulk stats logs to the database.
+    Returns a list of (period, timestamp) pairs giving the rollup bucket that
+    the given unix timestamp falls into for each of the rollup periods.
+    """
+    ts = datetime.datetime.utcfromtimestamp(ts).replace(tzinfo=pytz.utc)
+    hour = ts.replace(minute=0, second=0, microsecond=0)
+    day = hour.replace(hour=0)
+    month = day.replace(day=1)
+    year = month.replace(month=1)
+    return zip(ROLLUP_PERIODS, (hour, day, month, year))
+
+
+def execute_values(statements, template, rows, retries=3, fetch_all=False):
+    """
+    Renders ``rows`` through ``template`` into a list of SQL tuples and
+    executes each of ``statements`` in a single transaction, substituting the
+    list for their ``%(values)s`` placeholder.  Returns the rows fetched by the
+    last statement, if it produced any, or with ``fetch_all``, a list of the
+    rows fetched by each statement.
+
+    The statements are expected to be written as "insert where not exists" or
+    "update from values", so if one of them loses a race against a concurrent
+    insert of the same key and hits a unique violation, the whole transaction
+    is retried; by then the conflicting row is visible and the retry is a
+    no-op for it.  Other integrity errors would only fail again, so they are
+    raised straight away.
+
+    Concurrent batches often touch the same rows, like the current hour's
+    counters, so the rows are sorted to have every transaction lock them in
+    the same order.  A transaction that still deadlocks is retried as well.
     """
-    LOG_INSERT_SQL = """
-    INSERT INTO stats_log (
+    rows = sorted(rows)
+    for attempt in xrange(retries):
+        try:
+            with db.cursor() as cursor:
+                values = ','.join([cursor.mogrify(template, row)
+                    for row in rows])
+                results = []
+                for statement in statements:
+                    cursor.execute(statement % {'values': values})
+                    if cursor.description is None:
+                        results.append([])
+                    else:
+                        results.append(cursor.fetchall())
+                return results if fetch_all else results[-1]
+        except psycopg2.extensions.TransactionRollbackError:
+            if attempt == retries - 1:
+                raise
+        except psycopg2.IntegrityError, e:
+            if (e.pgcode != psycopg2.errorcodes.UNIQUE_VIOLATION or
+                    attempt == retries - 1):
+                raise
+        # Don't collide with the same transaction again straight away
+        gevent.sleep(random.random() * 0.05 * (attempt + 1))
+
+
+def _insert_logs(table, rows):
+    SQL = """
+    INSERT INTO %s (
         timestamp, action, data, udid, api_version, app_version,
         bundle_version, app_key, uuid, platform
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    """
+    )
+    SELECT * FROM (VALUES %%(values)s) AS V (
+        timestamp, action, data, udid, api_version, app_version,
+        bundle_version, app_key, uuid, platform
+    )
+    WHERE NOT EXISTS (
+        SELECT 1 FROM %s L
+        WHERE L.uuid = V.uuid OR (L.timestamp = V.timestamp AND L.udid = V.udid)
+    )
+    RETURNING uuid
+    """ % (table, table)
+    TEMPLATE = '(%s::float8, %s, %s, %s, %s, %s::integer, %s, %s, %s, %s)'
+    return set([r[0] for r in execute_values([SQL], TEMPLATE, rows)])
 
-    UNIQUE_INSERT_SQL = """
-    INSERT INTO stats_unique%s (app_id, udid, platform, new, timestamp)
-    VALUES (%%s, %%s, %%s, %%s, %%s)
+
+def insert_logs(table, rows):
     """
+    Inserts raw log rows into the given log table with one statement, skipping
+    any whose uuid or (timestamp, udid) pair has already been recorded, and
+    returns the set of uuids that were actually inserted.
+
+    With partitioning enabled, rows go straight into the partition for their
+    month.  A retried log carries the same timestamp as the original, and
+    the partition_logs command moves each partition's month out of the parent
+    table, so the duplicate check only has to look at that one partition.
+    Without it, rows go into the parent table, which only has the trigger
+    that routes rows into the partitions, and so hides them from ``RETURNING``,
+    while partitioning is enabled.
+    """
+    # Duplicates within the batch itself would never be caught by the NOT
+    # EXISTS clause, so drop them up front.
+    seen = set()
+    unique_rows = []
+    for row in rows:
+        if row[8] in seen or (row[0], row[3]) in seen:
+            continue
+        seen.add(row[8])
+        seen.add((row[0], row[3]))
+        unique_rows.append(row)
+    if not unique_rows:
+        return set()
+    if not LOG_PARTITIONS:
+        return _insert_logs(table, unique_rows)
+
+    by_month = defaultdict(list)
+    for row in unique_rows:
+        by_month[partitions.get_month(row[0])].append(row)
+    inserted = set()
+    for month, month_rows in by_month.iteritems():
+        try:
+            inserted |= _insert_logs(
+                partitions.get_partition_name(table, month), month_rows)
+        except psycopg2.ProgrammingError, e:
+            if e.pgcode != psycopg2.errorcodes.UNDEFINED_TABLE:
+                raise
+            # There is no partition for this month, so leave the rows in the
+            # parent table.
+            inserted |= _insert_logs(table, month_rows)
+    return inserted
+
+
+def increment_counters(table, columns, counters, counts):
+    """
+    Adds the increments in ``counts``, a dictionary mapping a tuple of values
+    for ``columns`` to a tuple of increments for ``counters``, onto the
+    counter columns of the given rollup table.  Existing rows are updated and
+    missing rows are created, one statement each for the whole batch.
+    """
+    if not counts:
+        return
+    UPDATE_SQL = """
+    UPDATE %(table)s S
+    SET %(increments)s
+    FROM (VALUES %%(values)s) AS V (%(columns)s, %(counters)s)
+    WHERE %(match)s
+    """
+    INSERT_SQL = """
+    INSERT INTO %(table)s (%(columns)s, %(counters)s)
+    SELECT * FROM (VALUES %%(values)s) AS V (%(columns)s, %(counters)s)
+    WHERE NOT EXISTS (SELECT 1 FROM %(table)s S WHERE %(match)s)
+    """
+    fmt = {
+        'table': table,
+        'columns': ', '.join(columns),
+        'counters': ', '.join(counters),
+        'increments': ', '.join(['%s = S.%s + V.%s' % (c, c, c)
+            for c in counters]),
+        'match': ' AND '.join(['S.%s = V.%s' % (c, c) for c in columns]),
+    }
+    template = '(%s)' % (', '.join(['%s'] * (len(columns) + len(counters))),)
+
+    # The UPDATE has to run first, otherwise it would double-count the rows
+    # that the INSERT just created.
+    execute_values([UPDATE_SQL % fmt, INSERT_SQL % fmt], template,
+        [key + tuple(values) for key, values in counts.iteritems()])
+
+
+def increment_views(table, columns, counts):
+    """
+    Adds the increments in ``counts``, a dictionary mapping a tuple of values
+    for ``columns`` to a number of views, onto the views column of the given
+    rollup table.
+    """
+    increment_counters(table, columns, ('views',), dict(((key, (views,))
+        for key, views in counts.iteritems())))
+
+
+known_devices = GenerationalSet(KNOWN_DEVICES_MAX_SIZE)
+
 
-    UNIQUE_ALLTIME_INSERT_SQL = """
+def insert_unique_alltime(app_id, udid, platform):
+    """
+    Records the device in stats_uniquealltime if it isn't there yet, and
+    returns whether it was new.  Devices known to be recorded already are
+    answered from memory without going to the database.
+    """
+    SQL = """
     INSERT INTO stats_uniquealltime (app_id, udid, platform)
-    VALUES (%s, %s, %s)
+    SELECT %s, %s, %s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM stats_uniquealltime U
+        WHERE U.app_id = %s AND U.udid = %s AND U.platform = %s
+    )
     """
+    key = (app_id, udid, platform)
+    if key in known_devices:
+        return False
+    try:
+        new = db.execute(SQL, list(key) * 2) == 1
+    except psycopg2.IntegrityError:
+        new = False
+    db.on_commit(known_devices.add, key)
+    return new
+
+
+view_aggregator = CounterAggregator(increment_views,
+    interval=VIEW_FLUSH_INTERVAL, max_keys=VIEW_FLUSH_MAX_KEYS)
+
+
+def _increment_views(table, columns, counts):
+    if VIEW_FLUSH_INTERVAL:
+        db.on_commit(view_aggregator.add, table, columns, counts)
+    else:
+        increment_views(table, columns, counts)
+
 
-    VIEW_UPDATE_SQL = """
-    UPDATE stats_view%s
-    SET views = views + 1
-    WHERE app_id = %%s AND platform = %%s AND timestamp = %%s
+def insert_uniques(period, rows):
     """
-    VIEW_INSERT_SQL = """
-    INSERT INTO stats_view%s (app_id, platform, timestamp, views)
-    VALUES (%%s, %%s, %%s, 1)
+    Inserts (app_id, udid, platform, new, timestamp) rows into the unique
+    users rollup table for the given period, skipping those already present.
     """
+    if not rows:
+        return
+    SQL = """
+    INSERT INTO stats_unique%s (app_id, udid, platform, new, timestamp)
+    SELECT * FROM (VALUES %%(values)s) AS V (
+        app_id, udid, platform, new, timestamp
+    )
+    WHERE NOT EXISTS (
+        SELECT 1 FROM stats_unique%s U
+        WHERE
+            U.app_id = V.app_id AND
+            U.udid = V.udid AND
+            U.platform = V.platform AND
+            U.timestamp = V.timestamp
+    )
+    """ % (period, period)
+    execute_values([SQL], '(%s, %s, %s, %s, %s)', rows)
+
 
-    VIEW_SLUG_UPDATE_SQL = """
-    UPDATE stats_viewslug%s
-    SET views = views + 1
-    WHERE app_id = %%s AND platform = %%s AND timestamp = %%s AND slug = %%s
+def merge_unique_sketches(sketches):
     """
-    VIEW_SLUG_INSERT_SQL = """
-    INSERT INTO stats_viewslug%s (app_id, platform, timestamp, views, slug)
-    VALUES (%%s, %%s, %%s, 1, %%s)
+    Merges buffered registers into the unique user sketches in
+    stats_uniquesketch, creating any that don't exist yet.  ``sketches`` maps
+    (app_id, platform, period, timestamp) keys to a pair of dictionaries, for
+    all users and for new users, mapping zero-based register indexes to
+    ranks.  Each sketch is written once, with the element-wise maximum of its
+    stored and buffered registers.
     """
-
-    app = get_app_from_key(app_key)
-    if not app:
+    if not sketches:
         return
-    app_id = app['id']
+    fmt = {'size': hll.NUM_REGISTERS}
+    INSERT_SQL = """
+    INSERT INTO stats_uniquesketch
+        (app_id, platform, period, timestamp, registers, new_registers)
+    SELECT
+        V.app_id, V.platform, V.period, V.timestamp,
+        array_fill(0::smallint, ARRAY[%(size)d]),
+        array_fill(0::smallint, ARRAY[%(size)d])
+    FROM (VALUES %%(values)s) AS V (
+        app_id, platform, period, timestamp, registers, new_registers
+    )
+    WHERE NOT EXISTS (
+        SELECT 1 FROM stats_uniquesketch S
+        WHERE
+            S.app_id = V.app_id AND
+            S.platform = V.platform AND
+            S.period = V.period AND
+            S.timestamp = V.timestamp
+    )
+    """ % fmt
+    UPDATE_SQL = """
+    UPDATE stats_uniquesketch S
+    SET
+        registers = ARRAY(
+            SELECT GREATEST(S.registers[i], V.registers[i])
+            FROM generate_series(1, %(size)d) AS i ORDER BY i
+        ),
+        new_registers = ARRAY(
+            SELECT GREATEST(S.new_registers[i], V.new_registers[i])
+            FROM generate_series(1, %(size)d) AS i ORDER BY i
+        )
+    FROM (VALUES %%(values)s) AS V (
+        app_id, platform, period, timestamp, registers, new_registers
+    )
+    WHERE
+        S.app_id = V.app_id AND
+        S.platform = V.platform AND
+        S.period = V.period AND
+        S.timestamp = V.timestamp
+    """ % fmt
+    rows = []
+    for key, pair in sketches.iteritems():
+        dense = []
+        for updates in pair:
+            registers = hll.empty()
+            for index, rank in updates.iteritems():
+                registers[index] = rank
+            dense.append(registers)
+        rows.append(key + tuple(dense))
+    execute_values([INSERT_SQL, UPDATE_SQL],
+        '(%s, %s, %s, %s, %s::smallint[], %s::smallint[])', rows)
+
+
+sketch_aggregator = SketchAggregator(merge_unique_sketches,
+    interval=SKETCH_FLUSH_INTERVAL)
+
+
+class _SerialPool(object):
+    """
+    Stands in for the pool of greenlets that a batch is ingested with when it
+    is ingested in one transaction, whose statements have to take turns on
+    its connection.
+    """
 
-    pool = Pool(10)
+    def spawn(self, func, *args):
+        result = AsyncResult()
+        result.set(func(*args))
+        return result
 
-    def _coro0(log):
-        try:
-            db.execute(LOG_INSERT_SQL, [
-                log['ts'],
-                log['action'],
-                simplejson.dumps(log['data']),
-                udid,
-                api_version,
-                app_version,
-                bundle_version,
-                app_key,
-                log['uuid'],
-                platform,
-            ])
-        except psycopg2.IntegrityError:
-            return
+    spawn_link_exception = spawn
 
-        # Don't care about disappearing in aggregate yet
-        if log['action'] == 'viewDidDisappear':
-            return
+    def join(self):
+        pass
 
-        slug = log['data']['slug']
 
-        ts = datetime.datetime.utcfromtimestamp(log['ts']).replace(
-            tzinfo=pytz.utc)
-        hour = ts.replace(minute=0, second=0, microsecond=0)
-        day = hour.replace(hour=0)
-        month = day.replace(day=1)
-        year = month.replace(month=1)
-
-        try:
-            db.execute(UNIQUE_ALLTIME_INSERT_SQL,
-                [app_id, udid, platform])
-            new = True
-        except psycopg2.IntegrityError:
-            new = False
-
-        pt = zip(('hour', 'day', 'month', 'year'), (hour, day, month, year))
-        for period, timestamp in pt:
-            pool.spawn_link_exception(_coro1, period, timestamp, slug, new)
-            pool.spawn_link_exception(_coro2, period, timestamp, slug)
-            pool.spawn_link_exception(_coro3, period, timestamp, slug)
-
-    def _coro1(period, timestamp, slug, new):
-        try:
-            db.execute(UNIQUE_INSERT_SQL % (period,),
-                [app_id, udid, platform, new, timestamp])
-        except psycopg2.IntegrityError:
-            pass
+def _get_ingest_pool():
+    if db.in_transaction():
+        return _SerialPool()
+    return Pool(INGEST_CONCURRENCY)
 
-    def _coro2(period, timestamp, slug):
-        args = [app_id, platform, timestamp]
-        try:
-            db.execute(VIEW_INSERT_SQL % (period,), args)
-        except psycopg2.IntegrityError:
-            db.execute(VIEW_UPDATE_SQL % (period,), args)
 
-    def _coro3(period, timestamp, slug):
-        args = [app_id, platform, timestamp, slug]
-        try:
-            db.execute(VIEW_SLUG_INSERT_SQL % (period,), args)
-        except psycopg2.IntegrityError:
-            db.execute(VIEW_SLUG_UPDATE_SQL % (period,), args)
+def apply_atomically(func):
+    """
+    Wraps an ingest function like add_bulk_stats_logs so that the logs and
+    everything counted from them are committed together or not at all, so
+    that a batch that failed can be retried without losing its rollups to
+    the check for logs that are already recorded.
+    """
+    def _inner(*args):
+        with db.transaction():
+            return func(*args)
+    return _inner
 
-    for log in logs:
-        pool.spawn_link_exception(_coro0, log)
 
-    pool.join()
+def _check_log(i, log, fields):
+    for name, types in fields:
+        value = log.get(name) if isinstance(log, dict) else None
+        if not isinstance(value, types) or isinstance(value, bool):
+            return 'log %d has no valid %r' % (i, name)
+    return None
 
 
-def add_bulk_ab_logs(udid, api_version, app_version, bundle_version, app_key,
-    platform, logs):
+def check_stats_logs(logs):
     """
-    Adds bulk ab testing logs to the database.
+    Returns what is wrong with the first log in a stats batch that
+    add_bulk_stats_logs can't ingest, or None if they are all fine.
     """
-    LOG_INSERT_SQL = """
-    INSERT INTO ab_log (
-        timestamp, action, data, udid, api_version, app_version,
-        bundle_version, app_key, uuid, platform
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    if not isinstance(logs, list):
+        return 'logs is not a list'
+    for i, log in enumerate(logs):
+        problem = _check_log(i, log, (('ts', (int, long, float)),
+            ('uuid', basestring), ('action', basestring), ('data', dict)))
+        if problem is None and log['action'] != 'viewDidDisappear':
+            problem = _check_log(i, log['data'], (('slug', basestring),))
+        if problem is not None:
+            return problem
+    return None
+
+
+def check_ab_logs(logs):
     """
+    Returns what is wrong with the first log in an A/B batch that
+    add_bulk_ab_logs can't ingest, or None if they are all fine.
+    """
+    if not isinstance(logs, list):
+        return 'logs is not a list'
+    for i, log in enumerate(logs):
+        # Logs without data are skipped
+        if not isinstance(log, dict) or 'data' not in log:
+            continue
+        problem = _check_log(i, log, (('ts', (int, long, float)),
+            ('uuid', basestring), ('data', dict)))
+        if problem is None:
+            problem = _check_log(i, log['data'], (('action', basestring),))
+        if problem is None and log['data']['action'] != 'failure':
+            data = log['data']
+            fields = [('name', basestring)]
+            if 'num_choices' in data:
+                fields.append(('num_choices', (int, long)))
+            if data['action'] == 'test':
+                fields.append(('choice', (int, long)))
+            problem = _check_log(i, data, fields)
+        if problem is not None:
+            return problem
+    return None
 
-    UNIQUE_INSERT_SQL = """
-    INSERT INTO ab_uniquemonth (uuid, app_id, udid, month, date_created)
-    VALUES (%s, %s, %s, %s, %s)
+
+def add_bulk_stats_logs(udid, api_version, app_version, bundle_version,
+    app_key, platform, logs):
+    """
+    Adds bulk stats logs to the database.
+
+    The whole batch is aggregated in memory first, so the number of statements
+    issued depends on the number of distinct rollup buckets the logs fall into
+    rather than on the number of logs.
     """
+    app = get_app_from_key(app_key)
+    if not app:
+        return
+    app_id = app['id']
+
+    inserted = insert_logs('stats_log', [(
+        log['ts'],
+        log['action'],
+        simplejson.dumps(log['data']),
+        udid,
+        api_version,
+        app_version,
+        bundle_version,
+        app_key,
+        log['uuid'],
+        platform,
+    ) for log in logs])
+
+    # Don't care about disappearing in aggregate yet
+    logs = [log for log in logs if log['uuid'] in inserted and
+        log['action'] != 'viewDidDisappear']
+    if not logs:
+        return
+
+    new = insert_unique_alltime(app_id, udid, platform)
+
+    # Only the buckets holding the device's first event count as new
+    first = dict(_get_buckets(min([log['ts'] for log in logs])))
 
-    EXP_INSERT_SQL = """
+    uniques = dict(((period, set()) for period in ROLLUP_PERIODS))
+    views = dict(((period, defaultdict(int)) for period in ROLLUP_PERIODS))
+    slug_views = dict(((period, defaultdict(int))
+        for period in ROLLUP_PERIODS))
+    for log in logs:
+        slug = log['data']['slug']
+        for period, timestamp in _get_buckets(log['ts']):
+            uniques[period].add(timestamp)
+            views[period][(app_id, platform, timestamp)] += 1
+            slug_views[period][(app_id, platform, timestamp, slug)] += 1
+
+    if STATS_UNIQUE_SKETCHES:
+        index, rank = hll.get_register(udid)
+        for period in ROLLUP_PERIODS:
+            for ts in uniques[period]:
+                sketch_aggregator.add((app_id, platform, period, ts), index,
+                    rank, new and ts == first[period])
+
+    pool = _get_ingest_pool()
+    for period in ROLLUP_PERIODS:
+        if not STATS_UNIQUE_SKETCHES:
+            pool.spawn_link_exception(insert_uniques, period, [
+                (app_id, udid, platform, new and ts == first[period], ts)
+                for ts in uniques[period]
+            ])
+        pool.spawn_link_exception(_increment_views, 'stats_view' + period,
+            ('app_id', 'platform', 'timestamp'), views[period])
+        pool.spawn_link_exception(_increment_views, 'stats_viewslug' + period,
+            ('app_id', 'platform', 'timestamp', 'slug'), slug_views[period])
+    pool.join()
+
+
+def create_experiment(app_id, name, has_data, now):
+    """
+    Creates an experiment for the given slug on the fly, returning the one
+    that's already there if another request got to it first.
+    """
+    SQL = """
     INSERT INTO ab_experiment
         (app_id, name, slug, has_data, num_choices, enabled, date_created)
     VALUES (%s, %s, %s, %s, %s, %s, %s)
+    RETURNING *
+    """
+    try:
+        return db.fetchone(SQL, [app_id, 'Experiment for ' + name, name,
+            has_data, 0, True, now])
+    except psycopg2.IntegrityError:
+        return get_experiment(app_id, name)
+
+
+def update_num_choices(experiment, num_choices, now):
+    """
+    Records a new number of choices for the experiment and creates any
+    variations that don't exist yet.
     """
     EXP_UPDATE_SQL = """
     UPDATE ab_experiment SET num_choices = %s WHERE id = %s
     """
-
     VARIATION_INSERT_SQL = """
     INSERT INTO ab_variation
         (experiment_id, weight, num, name, data, date_created)
-    VALUES (%s, %s, %s, %s, %s, %s)
+    SELECT * FROM (VALUES %(values)s) AS V (
+        experiment_id, weight, num, name, data, date_created
+    )
+    WHERE NOT EXISTS (
+        SELECT 1 FROM ab_variation A
+        WHERE A.experiment_id = V.experiment_id AND A.num = V.num
+    )
+    """
+    db.execute(EXP_UPDATE_SQL, [num_choices, experiment['id']])
+    execute_values([VARIATION_INSERT_SQL], '(%s, %s, %s, %s, %s, %s)', [(
+        experiment['id'],
+        0.5 / num_choices,
+        i + 1,
+        'Test ' + 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'[i],
+        '{\n}' if experiment['has_data'] else '',
+        now,
+    ) for i in xrange(num_choices)])
+
+
+def insert_ab_uniques(rows):
     """
+    Inserts (uuid, app_id, udid, month, date_created) rows into
+    ab_uniquemonth, skipping those already present.
+    """
+    if not rows:
+        return
+    SQL = """
+    INSERT INTO ab_uniquemonth (uuid, app_id, udid, month, date_created)
+    SELECT * FROM (VALUES %(values)s) AS V (
+        uuid, app_id, udid, month, date_created
+    )
+    WHERE NOT EXISTS (
+        SELECT 1 FROM ab_uniquemonth U
+        WHERE U.app_id = V.app_id AND U.month = V.month AND U.udid = V.udid
+    )
+    """
+    execute_values([SQL], '(%s, %s, %s, %s, %s)', rows)
+
 
-    TRIAL_INSERT_SQL = """
+def insert_trials(rows):
+    """
+    Inserts (uuid, udid, app_id, experiment_id, date_created, date_started,
+    choice) rows into ab_trial.  A device that already has a trial for an
+    experiment keeps it.  Returns (experiment_id, choice, date_started) for
+    each trial that was actually started.
+    """
+    if not rows:
+        return []
+    SQL = """
     INSERT INTO ab_trial
         (uuid, udid, app_id, experiment_id, date_created, date_started,
-            date_completed, choice, goal_reached)
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            choice, goal_reached)
+    SELECT V.*, FALSE FROM (VALUES %(values)s) AS V (
+        uuid, udid, app_id, experiment_id, date_created, date_started, choice
+    )
+    WHERE NOT EXISTS (
+        SELECT 1 FROM ab_trial T
+        WHERE T.udid = V.udid AND T.experiment_id = V.experiment_id
+    )
+    RETURNING experiment_id, choice, date_started
+    """
+    # What is the expected behavior here?  If a trial is already started for
+    # this user, then do we discard the old one, or do we start a new one with
+    # a new timestamp and choice?  Do we update the started timestamp on the
+    # current one?  Not sure.  For now the first trial wins.
+    first = {}
+    for row in rows:
+        first.setdefault((row[1], row[3]), row)
+    return execute_values([SQL], '(%s, %s, %s, %s, %s, %s, %s)',
+        first.values())
+
+
+# Running totals of the goals applied by complete_trials, and of how many of
+# them had no trial to attribute them to.
+goal_counters = {
+    'goals': 0,
+    'unmatched': 0,
+}
+
+
+def complete_trials(rows):
+    """
+    Marks the trials identified by (udid, experiment_id, date_completed) rows
+    as having reached their goal, in one transaction.  Returns (experiment_id,
+    choice, date_started) for each trial that reached its goal for the first
+    time.
+    """
+    if not rows:
+        return []
+    # Trials that had already reached their goal only get the new date.  The
+    # rest are only returned by the second statement if it is the one to
+    # flip goal_reached, which the row lock decides between concurrent
+    # batches, so that each first success is counted once.
+    REPEAT_SQL = """
+    UPDATE ab_trial T
+    SET date_completed = V.date_completed
+    FROM (VALUES %(values)s) AS V (udid, experiment_id, date_completed)
+    WHERE
+        T.udid = V.udid AND
+        T.experiment_id = V.experiment_id AND
+        T.goal_reached
+    RETURNING T.uuid
     """
-    TRIAL_UPDATE_SQL = """
-    UPDATE ab_trial
-    SET date_completed = %s, goal_reached = %s
-    WHERE udid = %s AND experiment_id = %s
+    FIRST_SQL = """
+    UPDATE ab_trial T
+    SET date_completed = V.date_completed, goal_reached = TRUE
+    FROM (VALUES %(values)s) AS V (udid, experiment_id, date_completed)
+    WHERE
+        T.udid = V.udid AND
+        T.experiment_id = V.experiment_id AND
+        NOT T.goal_reached
+    RETURNING T.experiment_id, T.choice, T.date_started
+    """
+    # The last goal logged for a trial is the one that sticks
+    last = {}
+    for row in rows:
+        last[row[:2]] = row
+    repeats, firsts = execute_values([REPEAT_SQL, FIRST_SQL], '(%s, %s, %s)',
+        last.values(), fetch_all=True)
+    goal_counters['goals'] += len(last)
+    goal_counters['unmatched'] += len(last) - len(repeats) - len(firsts)
+    return [tuple(row) for row in firsts]
+
+
+def increment_trial_counts(started, completed):
+    """
+    Adds newly started and newly successful trials, given as (experiment_id,
+    choice, date_started) rows, to the hourly and daily per-choice counts in
+    ab_trialcount, bucketed by UTC hour and day.
+    """
+    counts = defaultdict(lambda: [0, 0])
+    for i, trials in enumerate((started, completed)):
+        for experiment_id, choice, date_started in trials:
+            # psycopg2 hands back timestamps in the session's time zone, but
+            # the buckets are UTC hours and days, as rebuild_trial_counts
+            # makes them.
+            hour = date_started.astimezone(pytz.utc).replace(minute=0,
+                second=0, microsecond=0)
+            for period, timestamp in (('hour', hour), ('day',
+                hour.replace(hour=0))):
+                counts[(experiment_id, choice, period, timestamp)][i] += 1
+    increment_counters('ab_trialcount',
+        ('experiment_id', 'choice', 'period', 'timestamp'),
+        ('trials', 'successes'), counts)
+
+
+def add_bulk_ab_logs(udid, api_version, app_version, bundle_version, app_key,
+    platform, logs):
     """
+    Adds bulk ab testing logs to the database.
 
+    Experiments are looked up once for the whole batch, and the resulting
+    trials, goals and monthly uniques are each written with one statement.
+    """
     app = get_app_from_key(app_key)
     if not app:
         return
@@ -362,119 +941,79 @@ def add_bulk_ab_logs(udid, api_version, app_version, bundle_version, app_key,
 
     now = utils.get_now()
 
-    def insert_ab_log(log):
-        try:
-            data = log['data']
-        except KeyError:
-            # TODO: Log error somewhere?
-            return
-
-        try:
-            db.execute(LOG_INSERT_SQL, [
-                log['ts'],
-                data['action'],
-                simplejson.dumps(log['data']),
-                udid,
-                api_version,
-                app_version,
-                bundle_version,
-                app_key,
-                log['uuid'],
-                platform,
-            ])
-        except psycopg2.IntegrityError:
-            return
+    # TODO: Log logs without data somewhere?
+    logs = [log for log in logs if 'data' in log]
+
+    inserted = insert_logs('ab_log', [(
+        log['ts'],
+        log['data']['action'],
+        simplejson.dumps(log['data']),
+        udid,
+        api_version,
+        app_version,
+        bundle_version,
+        app_key,
+        log['uuid'],
+        platform,
+    ) for log in logs])
+    logs = [log for log in logs if log['uuid'] in inserted]
+    if not logs:
+        return
 
-        ts = datetime.datetime.utcfromtimestamp(log['ts']).replace(
+    for log in logs:
+        log['dt'] = datetime.datetime.utcfromtimestamp(log['ts']).replace(
             tzinfo=pytz.utc)
-        month = ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
 
-        try:
-            db.execute(UNIQUE_INSERT_SQL,
-                [str(uuid.uuid1()), app_id, udid, month, now])
-        except psycopg2.IntegrityError:
-            pass
+    pool = _get_ingest_pool()
+    months = set([log['dt'].replace(day=1, hour=0, minute=0, second=0,
+        microsecond=0) for log in logs])
+    pool.spawn_link_exception(insert_ab_uniques, [
+        (str(uuid.uuid1()), app_id, udid, month, now) for month in months
+    ])
+
+    experiments = dict(((e['slug'].upper(), e)
+        for e in get_experiments_for_app(app_id)))
+    trials = []
+    goals = []
+    for log in logs:
+        data = log['data']
 
         # Don't care about disappearing in aggregate yet
         if data['action'] == 'failure':
-            return
+            continue
 
-        experiment = get_experiment(app_id, data['name'])
+        experiment = experiments.get(data['name'].upper())
         if experiment is None:
             if 'has_data' not in data:
-                return
-            db.execute(EXP_INSERT_SQL, [
-                app_id,
-                'Experiment for ' + data['name'],
-                data['name'],
-                data['has_data'],
-                0,
-                True,
-                now,
-            ])
-            experiment = get_experiment(app_id, data['name'])
+                continue
+            experiment = create_experiment(app_id, data['name'],
+                data['has_data'], now)
+            experiments[data['name'].upper()] = experiment
 
         if 'num_choices' in data:
             if data['num_choices'] != experiment['num_choices']:
-                # First update the experiment object
-                db.execute(EXP_UPDATE_SQL,
-                    [data['num_choices'], experiment['id']])
-
-                # Now create any un-created variation objects
-                for i in xrange(data['num_choices']):
-                    try:
-                        name = 'Test ' + ('ABCDEFGHIJKLMNOPQRSTUVWXYZ'[i],)
-                        db.execute(VARIATION_INSERT_SQL, [
-                            experiment['id'],
-                            0.5 / data['num_choices'],
-                            i + 1,
-                            name,
-                            '{\n}' if experiment['has_data'] else '',
-                            now,
-                        ])
-                    except psycopg2.IntegrityError:
-                        pass
+                update_num_choices(experiment, data['num_choices'], now)
+                experiment['num_choices'] = data['num_choices']
 
             # If it's one of the 'num-choices' actions, we've done that
             # already so we can continue on.
             if data['action'] == 'num-choices':
-                return
+                continue
 
         if data['action'] == 'test':
-            try:
-                dt = datetime.datetime.utcfromtimestamp(log['ts']).replace(
-                    tzinfo=pytz.utc)
-                db.execute(TRIAL_INSERT_SQL, [
-                    str(uuid.uuid1()),
-                    udid,
-                    app_id,
-                    experiment['id'],
-                    now,
-                    dt,
-                    None,
-                    data['choice'],
-                    False,
-                ])
-            except psycopg2.IntegrityError:
-                # What is the expected behavior here?  If a trial is
-                # already started for this user, then do we discard the old
-                # one, or do we start a new one with a new timestamp and
-                # choice?  Do we update the started timestamp on the
-                # current one?  Not sure.  For now we just continue and do
-                # nothing.
-                pass
-
-            return
-
-        if data['action'] == 'goal':
-            dt = datetime.datetime.utcfromtimestamp(log['ts']).replace(
-                tzinfo=pytz.utc)
-            db.execute(TRIAL_UPDATE_SQL, [
-                dt,
-                True,
-                udid,
-                experiment['id'],
-            ])
+            trials.append((str(uuid.uuid1()), udid, app_id, experiment['id'],
+                now, log['dt'], data['choice']))
+        elif data['action'] == 'goal':
+            goals.append((udid, experiment['id'], log['dt']))
+
+    # Goals for trials started earlier in this same batch have to wait until
+    # those trials exist, but the rest can be applied alongside them.
+    starting = set([trial[3] for trial in trials])
+    early = pool.spawn(complete_trials,
+        [goal for goal in goals if goal[1] not in starting])
+    started = insert_trials(trials)
+    completed = complete_trials(
+        [goal for goal in goals if goal[1] in starting])
+    increment_trial_counts(started, completed + early.get())
 
-    for log in logs:
-        insert_ab_log(log)
+    pool.join()
@@ -12,71 +12,208 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import datetime
 import hashlib
 import plistlib
+import tempfile
+import zipfile
 
+import gevent
 import simplejson
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
-
-from django.core.cache import cache
+from django.core.cache import get_cache
+from gevent.coros import Semaphore
 
 from clutch import settings
 
 from clutchrpc import db
+from clutchrpc import limits
+from clutchrpc import spool
+from clutchrpc import storage
 from clutchrpc import utils
+from clutchrpc.cache import ImmutableCache, TTLCache
+
+# How many manifests and clutch.plist files to keep in memory.  They are also
+# shared between processes through the Django cache backend named by
+# CLUTCH_RPC_SHARED_CACHE, if it is set.  That only helps with a backend that
+# the processes really share, like memcached, and not with the per-process
+# local memory backend.
+VERSION_CACHE_MAX_SIZE = getattr(settings, 'CLUTCH_RPC_VERSION_CACHE_MAX_SIZE',
+    2000)
+SHARED_CACHE = getattr(settings, 'CLUTCH_RPC_SHARED_CACHE', None)
+
+# How many seconds to remember that a version, or one of its files, doesn't
+# exist (yet), so that devices asking for an unknown version don't each go to
+# storage and the database.
+VERSION_CACHE_NEGATIVE_TTL = getattr(settings,
+    'CLUTCH_RPC_VERSION_CACHE_NEGATIVE_TTL', 5)
+
+# How many archives for get_bundle to build at once, in the background, and
+# how many seconds devices are told to wait for one that is being built.
+BUNDLE_BUILD_CONCURRENCY = getattr(settings,
+    'CLUTCH_RPC_BUNDLE_BUILD_CONCURRENCY', 2)
+BUNDLE_RETRY_AFTER = getattr(settings, 'CLUTCH_RPC_BUNDLE_RETRY_AFTER', 10)
+
+# How many times building a version's archive may fail before devices are
+# told that it can't be had, and for how many seconds after the last failure
+# that holds before it is tried again.
+BUNDLE_MAX_ATTEMPTS = getattr(settings, 'CLUTCH_RPC_BUNDLE_MAX_ATTEMPTS', 3)
+BUNDLE_FAILURE_TTL = getattr(settings, 'CLUTCH_RPC_BUNDLE_FAILURE_TTL', 600)
+
+# The files of an app version never change once it has been uploaded
+version_cache = ImmutableCache(VERSION_CACHE_MAX_SIZE,
+    shared=get_cache(SHARED_CACHE) if SHARED_CACHE else None,
+    prefix='clutchrpc-version-', negative_ttl=VERSION_CACHE_NEGATIVE_TTL)
+
+# The versions whose archives are being built, and the limit on how many
+bundle_builds = {}
+_bundle_semaphore = Semaphore(BUNDLE_BUILD_CONCURRENCY)
+
+# How many times in a row building each version's archive has failed
+bundle_failures = TTLCache(1000, BUNDLE_FAILURE_TTL)
+
+
+def _get_manifest_name(app_slug, app_version):
+    return '%s/%s/meta/manifest.json' % (app_slug, app_version)
+
+
+def _fetch_objects(app_slug, app_version):
+    """
+    Returns the index of the version's files by content, False if the version
+    was stored without one, or None if it hasn't been uploaded (yet).
+    """
+    index = storage.get(storage.get_index_name(app_slug, app_version))
+    if index is not None:
+        return simplejson.loads(index)
+    # The index is stored before the manifest
+    if storage.exists(_get_manifest_name(app_slug, app_version)):
+        return False
+    return None
+
+
+def _get_storage_name(app_slug, app_version, filename):
+    """
+    Returns the name that a file of the given app version is stored under,
+    or None if the version was stored by content and has no such file.
+    """
+    app_version = str(app_version)
+    objects = version_cache.get(('objects', app_slug, app_version),
+        _fetch_objects, app_slug, app_version)
+    if objects is None or objects is False:
+        return '%s/%s/files/%s' % (app_slug, app_version, filename)
+    digest = objects.get(filename)
+    if digest is None:
+        return None
+    return storage.get_object_name(app_slug, digest)
+
+
+def _fetch_file_list(app_slug, app_version):
+    manifest = storage.get(_get_manifest_name(app_slug, app_version))
+    if manifest is None:
+        return None
+    return simplejson.loads(manifest)
+
+
+def _fetch_file_diff(app_slug, old_version, new_version):
+    old = version_cache.get(('file-list', app_slug, old_version),
+        _fetch_file_list, app_slug, old_version)
+    new = version_cache.get(('file-list', app_slug, new_version),
+        _fetch_file_list, app_slug, new_version)
+    if old is None or new is None:
+        return None
+    added = {}
+    changed = {}
+    for name, digest in new.iteritems():
+        if name not in old:
+            added[name] = digest
+        elif old[name] != digest:
+            changed[name] = digest
+    return {
+        'added': added,
+        'changed': changed,
+        'removed': sorted(set(old) - set(new)),
+    }
 
 
-def _get_cache(key):
-    cache.get(hashlib.sha1(key).hexdigest())
-
-
-def _set_cache(key, value, timeout=60):
-    cache.set(hashlib.sha1(key).hexdigest(), value, timeout)
+def _fetch_user_conf(app_slug, app_version):
+    # Versions that haven't been uploaded yet have no conf, rather than an
+    # empty one
+    files = version_cache.get(('file-list', app_slug, app_version),
+        _fetch_file_list, app_slug, app_version)
+    if files is None:
+        return None
+    plist_key = _get_storage_name(app_slug, app_version, 'clutch.plist')
+    plist = plist_key and storage.get(plist_key)
+    if plist is None:
+        return {}
+    return plistlib.readPlistFromString(plist)
 
 
 def _get_file_list(app, app_version):
     if app_version == 0:
         return {}
-    resp = _get_cache('file-list-%s-%s' % (app['slug'], app_version))
-    if resp:
-        return resp
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_ACCESS_SECRET)
-    bucket = conn.get_bucket(settings.AWS_BUCKET_NAME, validate=False)
-    manifest_key = '%s/%s/meta/manifest.json' % (app['slug'], app_version)
-    key = Key(bucket, manifest_key)
-    resp = simplejson.loads(key.get_contents_as_string())
-    _set_cache('file-list-%s-%s' % (app['slug'], app_version), resp, 999999999)
-    return resp
+    return version_cache.get(('file-list', app['slug'], app_version),
+        _fetch_file_list, app['slug'], app_version)
+
+
+def _get_file_diff(app, old_version, new_version):
+    """
+    Returns the files added, changed and removed between two versions, or
+    None if the old version is unknown.
+    """
+    if old_version <= 0 or new_version == 0:
+        return None
+    return version_cache.get(
+        ('file-diff', app['slug'], old_version, new_version),
+        _fetch_file_diff, app['slug'], old_version, new_version)
 
 
 def _get_user_conf(app, app_version):
     if app_version == 0:
         return {}
-    resp = _get_cache('user-conf-%s-%s' % (app['slug'], app_version))
-    if resp:
-        return resp
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_ACCESS_SECRET)
-    bucket = conn.get_bucket(settings.AWS_BUCKET_NAME, validate=False)
-    plist_key = '%s/%s/files/clutch.plist' % (app['slug'], app_version)
-    key = Key(bucket, plist_key)
-    if not key:
-        return {}
-    resp = plistlib.readPlistFromString(key.get_contents_as_string())
-    _set_cache('user-conf-%s-%s' % (app['slug'], app_version), resp, 999999999)
-    return resp
+    return version_cache.get(('user-conf', app['slug'], app_version),
+        _fetch_user_conf, app['slug'], app_version)
+
+
+def _fetch_fingerprint(app_slug, app_version):
+    files = version_cache.get(('file-list', app_slug, app_version),
+        _fetch_file_list, app_slug, app_version)
+    if files is None:
+        return None
+    user_conf = version_cache.get(('user-conf', app_slug, app_version),
+        _fetch_user_conf, app_slug, app_version)
+    return hashlib.sha1(simplejson.dumps([app_version, files, user_conf],
+        sort_keys=True, default=repr)).hexdigest()
+
+
+def _get_fingerprint(app, app_version, dev):
+    """
+    Returns a fingerprint of everything that goes into a sync response, so
+    that clients can tell us which response they already have.
+    """
+    if app_version == 0:
+        version_fingerprint = None
+    else:
+        version_fingerprint = version_cache.get(
+            ('fingerprint', app['slug'], app_version),
+            _fetch_fingerprint, app['slug'], app_version)
+    dev_state = [dev.get('url'), dev.get('toolbar')] if dev else None
+    return hashlib.sha1(simplejson.dumps(
+        [version_fingerprint, dev_state])).hexdigest()
 
 
-def _get_conf(app, app_version, device):
-    dev = None
-    if device:
-        now = utils.get_now()
-        date_updated = now - datetime.timedelta(minutes=6)
-        dev = db.get_dev_mode(app['id'], device['user_id'], date_updated)
+def _get_dev_mode(app, device):
+    if not device:
+        return None
+    now = utils.get_now()
+    date_updated = now - datetime.timedelta(minutes=6)
+    return db.get_dev_mode(app['id'], device['user_id'], date_updated)
+
 
-    user_conf = _get_user_conf(app, app_version)
+def _get_conf(app, app_version, dev):
+    # Copied, since the cached conf is shared with other requests
+    user_conf = dict(_get_user_conf(app, app_version) or {})
 
     timestamps = []
     for key, value in user_conf.items():
@@ -93,8 +230,8 @@ def _get_conf(app, app_version, device):
     })
 
 
-def sync(request_json):
-    app = db.get_app_from_key(request_json['_app_key'])
+def sync(request_json, current_version=None, fingerprint=None):
+    app = db.get_app_for_request(request_json)
     if not app:
         data = {'app_key': request_json['_app_key']}
         return utils.jsonrpc_error(request_json, 8, data)
@@ -108,34 +245,176 @@ def sync(request_json):
         return utils.jsonrpc_error(request_json, 15, {})
 
     device = db.get_device_for_udid_and_app(request_json['_udid'], app['id'])
+    dev = _get_dev_mode(app, device)
+
+    # Clients that send back the fingerprint of the response they already
+    # have only need to hear that nothing has changed.
+    new_fingerprint = _get_fingerprint(app, app_version, dev)
+    if fingerprint == new_fingerprint:
+        return utils.jsonrpc_response(request_json, {
+            'not_modified': True,
+            'fingerprint': new_fingerprint,
+        })
+    resp = {
+        'conf': _get_conf(app, app_version, dev),
+        'fingerprint': new_fingerprint,
+    }
 
-    return utils.jsonrpc_response(request_json, {
-        'files': _get_file_list(app, app_version),
-        'conf': _get_conf(app, app_version, device),
-    })
+    # Clients that send the version they already have get just the changes
+    # since that version, if we still know what was in it.
+    diff = None
+    if current_version is not None:
+        try:
+            diff = _get_file_diff(app, int(current_version), app_version)
+        except (ValueError, TypeError):
+            pass
+    if diff is not None:
+        resp['diff'] = diff
+    else:
+        resp['files'] = _get_file_list(app, app_version) or {}
+    # Every device on the same version gets the same response
+    return utils.jsonrpc_response(request_json, resp)
 
 
 def get_file(request_json, filename=None):
-    app = db.get_app_from_key(request_json['_app_key'])
+    app = db.get_app_for_request(request_json)
     if not app:
         data = {'app_key': request_json['_app_key']}
         return utils.jsonrpc_error(request_json, 8, data)
 
-    conn = S3Connection(settings.AWS_ACCESS_KEY, settings.AWS_ACCESS_SECRET)
-    bucket = conn.get_bucket(settings.AWS_BUCKET_NAME, validate=False)
-    key = Key(bucket, '%s/%s/files/%s' % (
-        app['slug'],
-        request_json['_app_version'],
-        filename,
-    ))
-    if key is None:
+    name = _get_storage_name(app['slug'], request_json['_app_version'],
+        filename)
+    if name is None:
         return utils.jsonrpc_error(request_json, 4, {'filename': filename},
             code=404)
+    url = storage.get_file_url(name)
     if request_json['_platform'] == 'Android':
-        return utils.jsonrpc_response(request_json,
-            {'url': key.generate_url(120)})
+        return utils.jsonrpc_response(request_json, {'url': url})
     else:
-        return utils.redirect(key.generate_url(120))
+        return utils.redirect(url)
+
+
+def build_bundle(app_slug, app_version):
+    """
+    Stores a zip archive of every file in the given app version, unless there
+    already is one, and returns the name it is stored under.  Returns None
+    without storing anything if any of the version's files are missing, as
+    they are while it is still being uploaded.
+    """
+    name = storage.get_bundle_name(app_slug, app_version)
+    if storage.exists(name):
+        return name
+    files = version_cache.get(('file-list', app_slug, app_version),
+        _fetch_file_list, app_slug, app_version)
+    if files is None:
+        return None
+    # Files are added one at a time and the archive is streamed from a
+    # temporary file, so at most one file is held in memory.
+    with tempfile.TemporaryFile() as f:
+        zip_context = contextlib.closing(
+            zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED))
+        with zip_context as z:
+            for filename in sorted(files):
+                file_name = _get_storage_name(app_slug, app_version, filename)
+                data = file_name and storage.get(file_name)
+                if data is None:
+                    return None
+                z.writestr(filename, data)
+        f.seek(0)
+        storage.put_file(name, f, 'application/zip', immutable=True)
+    return name
+
+
+def _build_bundle(app_slug, app_version):
+    key = (app_slug, app_version)
+    _bundle_semaphore.acquire()
+    try:
+        name = build_bundle(app_slug, app_version)
+    except Exception:
+        utils.exception_printer(None)
+        name = None
+    finally:
+        _bundle_semaphore.release()
+        del bundle_builds[key]
+    if name is None:
+        bundle_failures.set(key, bundle_failures.get(key, 0) + 1)
+    else:
+        bundle_failures.delete(key)
+
+
+def start_bundle_build(app_slug, app_version):
+    """
+    Builds the archive for the given app version in the background, unless
+    it is already being built.
+    """
+    key = (app_slug, app_version)
+    if key not in bundle_builds:
+        bundle_builds[key] = gevent.spawn(_build_bundle, app_slug,
+            app_version)
+
+
+def _fetch_bundle_name(app_slug, app_version):
+    name = storage.get_bundle_name(app_slug, app_version)
+    if storage.exists(name):
+        return name
+    return None
+
+
+def _fetch_version_exists(app_id, app_version):
+    return db.app_version_exists(app_id, app_version) or None
+
+
+def get_bundle(request_json, version=None):
+    """
+    Returns a URL for a zip archive of every file in an app version, which is
+    much quicker for a device to download on first launch than fetching each
+    file with get_file.
+
+    The archive is built in the background the first time a version is
+    asked for.  Until it is ready, the response has no URL, and says how
+    many seconds to wait before asking again.  Once building it has failed
+    BUNDLE_MAX_ATTEMPTS times in a row, an error is returned instead.
+    """
+    app = db.get_app_for_request(request_json)
+    if not app:
+        data = {'app_key': request_json['_app_key']}
+        return utils.jsonrpc_error(request_json, 8, data)
+
+    # The same limit applies as for sync
+    if request_json['_app_version'] != '-1' and not app['enabled']:
+        return utils.jsonrpc_error(request_json, 15, {})
+
+    if version is None:
+        version = db.get_app_version_for_bundle_version(app['id'],
+            request_json['_bundle_version'])
+    try:
+        version = int(version)
+    except (ValueError, TypeError):
+        version = 0
+    exists = version > 0 and version_cache.get(
+        ('version-exists', app['id'], version), _fetch_version_exists,
+        app['id'], version)
+    if not exists:
+        return utils.jsonrpc_error(request_json, 16, {'version': version},
+            code=404)
+
+    name = version_cache.get(('bundle', app['slug'], version),
+        _fetch_bundle_name, app['slug'], version)
+    if name is None:
+        failures = bundle_failures.get((app['slug'], version), 0)
+        if failures >= BUNDLE_MAX_ATTEMPTS:
+            return utils.jsonrpc_error(request_json, 22, {'version': version},
+                code=500)
+        start_bundle_build(app['slug'], version)
+        return utils.jsonrpc_response(request_json, {
+            'url': None,
+            'version': version,
+            'retry_after': BUNDLE_RETRY_AFTER,
+        })
+    return utils.jsonrpc_response(request_json, {
+        'url': storage.get_file_url(name),
+        'version': version,
+    })
 
 
 def start_dev(request_json, app_slug=None, url=None, toolbar=None):
@@ -227,7 +506,10 @@ def device_authenticate(request_json, device_id=None, app_key=None):
 
 
 def stats(request_json, logs):
-    db.add_bulk_stats_logs(
+    problem = db.check_stats_logs(logs)
+    if problem is not None:
+        return utils.jsonrpc_error(request_json, 21, {'problem': problem})
+    args = [
         request_json['_udid'],
         request_json['_api_version'],
         request_json['_app_version'],
@@ -235,7 +517,10 @@ def stats(request_json, logs):
         request_json['_app_key'],
         request_json['_platform'],
         logs
-    )
+    ]
+    if not spool.append('stats', args):
+        with limits.bulk():
+            db.add_bulk_stats_logs(*args)
     return utils.jsonrpc_response(request_json, {'status': 'ok'})
 
 
@@ -247,5 +532,6 @@ def get_methods():
         'stop_dev': stop_dev,
         'start_dev': start_dev,
         'get_file': get_file,
+        'get_bundle': get_bundle,
         'sync': sync,
     }
@@ -0,0 +1,188 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Admission control for RPC calls.
+
+Each method may only have so many calls running at once, and so many more
+waiting for a turn.  Calls that would have to wait when the queue is full, or
+that wait too long, are turned away straight away with a hint of when to
+retry, instead of piling up on the database connection pool.  Waiting calls
+get their turns in the order they arrived.
+
+Bulk ingest calls that write their logs to the database themselves, rather
+than to the spool, also share one smaller limit while they do.  Each of them
+holds at most ``db.INGEST_CONCURRENCY + 1`` database connections at once, and
+the default limit is chosen so that they leave
+CLUTCH_RPC_RESERVED_CONNECTIONS connections free for the calls a user is
+waiting on.  The spool applies its batches under a limit of its own.
+"""
+
+import collections
+import contextlib
+
+from gevent.event import Event
+
+from clutch import settings
+
+from clutchrpc import db
+from clutchrpc.pg2 import db as pool
+
+# Limits for particular methods, as a dictionary mapping the method name to
+# (concurrency, queue size).  Other methods get the defaults.
+METHOD_LIMITS = getattr(settings, 'CLUTCH_RPC_METHOD_LIMITS', {})
+DEFAULT_CONCURRENCY = getattr(settings, 'CLUTCH_RPC_DEFAULT_CONCURRENCY', 50)
+DEFAULT_QUEUE_SIZE = getattr(settings, 'CLUTCH_RPC_DEFAULT_QUEUE_SIZE', 200)
+
+# How many bulk ingest calls may write to the database at once.  Unless it is
+# set, that is as many as fit in the database connection pool without
+# touching the reserved connections.
+RESERVED_CONNECTIONS = getattr(settings, 'CLUTCH_RPC_RESERVED_CONNECTIONS', 2)
+BULK_CONCURRENCY = getattr(settings, 'CLUTCH_RPC_BULK_CONCURRENCY',
+    max(1, (pool.maxsize - RESERVED_CONNECTIONS) //
+        (db.INGEST_CONCURRENCY + 1)))
+BULK_QUEUE_SIZE = getattr(settings, 'CLUTCH_RPC_BULK_QUEUE_SIZE', 500)
+
+# How many spooled batches may be written to the database at once
+SPOOL_CONCURRENCY = getattr(settings, 'CLUTCH_RPC_SPOOL_CONCURRENCY', 1)
+
+# How many seconds a call may wait for its turn, and how many seconds clients
+# that are turned away are told to wait before trying again.
+QUEUE_TIMEOUT = getattr(settings, 'CLUTCH_RPC_QUEUE_TIMEOUT', 5)
+RETRY_AFTER = getattr(settings, 'CLUTCH_RPC_RETRY_AFTER', 10)
+
+
+class Busy(Exception):
+    """
+    Raised by a call that was turned away part of the way through.
+    """
+
+
+class Limiter(object):
+    """
+    Lets up to ``concurrency`` callers in at once, with up to ``queue_size``
+    more waiting for a turn.  A caller that is done hands its turn straight to
+    the one that has been waiting longest.
+    """
+
+    def __init__(self, concurrency, queue_size):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.waiters = collections.deque()
+        self.rejected = 0
+
+    def acquire(self, timeout):
+        """
+        Returns whether the caller may go ahead, in which case it must call
+        ``release`` once it is done.
+        """
+        if (self.running >= self.concurrency or self.waiters) and (
+                len(self.waiters) >= self.queue_size):
+            self.rejected += 1
+            return False
+        if not self._wait(timeout):
+            self.rejected += 1
+            return False
+        return True
+
+    def _wait(self, timeout):
+        if self.running < self.concurrency and not self.waiters:
+            self.running += 1
+            return True
+        event = Event()
+        self.waiters.append(event)
+        try:
+            event.wait(timeout)
+        except:
+            if event.is_set():
+                self.release()
+            else:
+                self.waiters.remove(event)
+            raise
+        if not event.is_set():
+            self.waiters.remove(event)
+            return False
+        return True
+
+    def release(self):
+        if self.waiters:
+            self.waiters.popleft().set()
+        else:
+            self.running -= 1
+
+    @contextlib.contextmanager
+    def hold(self):
+        """
+        Waits for a turn however long it takes, for work in the background
+        that can't be turned away.
+        """
+        self._wait(None)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            'concurrency': self.concurrency,
+            'running': self.running,
+            'waiting': len(self.waiters),
+            'rejected': self.rejected,
+        }
+
+
+bulk_limiter = Limiter(BULK_CONCURRENCY, BULK_QUEUE_SIZE)
+spool_limiter = Limiter(SPOOL_CONCURRENCY, 0)
+
+method_limiters = {}
+
+
+def _get_limiter(method):
+    limiter = method_limiters.get(method)
+    if limiter is None:
+        concurrency, queue_size = METHOD_LIMITS.get(method,
+            (DEFAULT_CONCURRENCY, DEFAULT_QUEUE_SIZE))
+        limiter = method_limiters[method] = Limiter(concurrency, queue_size)
+    return limiter
+
+
+def acquire(method):
+    """
+    Waits for a turn to run a call to the given method.  Returns the limiter
+    to pass to ``release`` once the call is done, or None if the call should
+    be turned away.
+    """
+    limiter = _get_limiter(method)
+    if not limiter.acquire(QUEUE_TIMEOUT):
+        return None
+    return limiter
+
+
+def release(limiter):
+    limiter.release()
+
+
+@contextlib.contextmanager
+def bulk():
+    """
+    Waits for a turn for a bulk ingest call to write to the database, raising
+    Busy if the call should be turned away instead.
+    """
+    if not bulk_limiter.acquire(QUEUE_TIMEOUT):
+        raise Busy()
+    try:
+        yield
+    finally:
+        bulk_limiter.release()
@@ -0,0 +1,102 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Keeps the in-process caches of the RPC server in step with changes made by
+the dashboard, on this host or any other.
+
+The dashboard sends a Postgres NOTIFY on a channel when it changes something
+that clutchrpc caches, with the affected key as the payload, and a greenlet
+here LISTENs on a dedicated connection and hands each payload to the
+channel's handler.  A handler is called with None when notifications may have
+been missed, such as after reconnecting, and should then drop everything.
+If a handler fails on a payload, it is logged and called with None instead.
+If anything else goes wrong, the listener reconnects after a pause.
+"""
+
+import gevent
+
+from gevent.socket import wait_read
+from psycopg2 import extensions
+
+from clutch import settings
+
+from clutchrpc import db
+from clutchrpc import utils
+from clutchrpc.pg2 import db as pool
+
+from dashboard.utils import APP_KEY_CHANNEL
+
+RECONNECT_INTERVAL = getattr(settings, 'CLUTCH_RPC_LISTENER_RECONNECT_INTERVAL',
+    5)
+
+HANDLERS = {
+    APP_KEY_CHANNEL: db.invalidate_app_key,
+}
+
+_greenlet = None
+
+
+def _listen():
+    conn = pool.create_connection()
+    try:
+        conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+        for channel in HANDLERS:
+            cursor.execute('LISTEN %s' % (channel,))
+        # Anything could have changed while we weren't listening
+        for handler in HANDLERS.itervalues():
+            handler(None)
+        while True:
+            wait_read(conn.fileno())
+            conn.poll()
+            while conn.notifies:
+                _handle(conn.notifies.pop(0))
+    finally:
+        conn.close()
+
+
+def _handle(notify):
+    handler = HANDLERS.get(notify.channel)
+    if handler is None:
+        return
+    try:
+        handler(notify.payload or None)
+    except Exception:
+        utils.exception_printer(None)
+        # Dropping everything is the only way left to be sure the change
+        # isn't missed.  If that fails too, _run starts over.
+        handler(None)
+
+
+def _run():
+    while True:
+        try:
+            _listen()
+        except Exception:
+            utils.exception_printer(None)
+        gevent.sleep(RECONNECT_INTERVAL)
+
+
+def start():
+    global _greenlet
+    if _greenlet is None:
+        _greenlet = gevent.spawn(_run)
+
+
+def stop():
+    global _greenlet
+    if _greenlet is not None:
+        _greenlet.kill()
+        _greenlet = None
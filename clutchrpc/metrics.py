@@ -0,0 +1,287 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Counters and latency histograms for the RPC server, served at ``/metrics``
+in the Prometheus text exposition format, along with a sampled log of calls.
+
+Log entries are queued and written out to stdout by a background greenlet,
+which only writes while stdout can take more, so a slow reader never holds up
+the process.  When the queue is full, entries are dropped and counted
+instead.
+"""
+
+import bisect
+import os
+import random
+import select
+import sys
+import time
+
+from collections import defaultdict
+
+import gevent
+import simplejson
+
+from gevent.queue import Queue, Full
+from gevent.socket import wait_write
+
+from clutch import settings
+
+from clutchrpc import db
+from clutchrpc import framework
+from clutchrpc import limits
+from clutchrpc import spool
+from clutchrpc import storage
+from clutchrpc.pg2 import db as pool
+
+# The fraction of successful calls to log.  Failed calls are always logged.
+LOG_SAMPLE_RATE = getattr(settings, 'CLUTCH_RPC_LOG_SAMPLE_RATE', 0.01)
+LOG_QUEUE_SIZE = getattr(settings, 'CLUTCH_RPC_LOG_QUEUE_SIZE', 1000)
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Writes to a pipe of up to this many bytes don't block once it is writable
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(BUCKETS, value)
+        if i < len(BUCKETS):
+            self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+calls = defaultdict(int)
+errors = defaultdict(int)
+latencies = defaultdict(Histogram)
+log_counters = {
+    'logged': 0,
+    'dropped': 0,
+}
+
+_log_queue = Queue(LOG_QUEUE_SIZE)
+_log_greenlet = None
+
+
+def record_call(method, elapsed, error_code=None, detail=None):
+    calls[method] += 1
+    latencies[method].observe(elapsed)
+    if error_code is not None:
+        errors[(method, error_code)] += 1
+    if error_code is None and random.random() >= LOG_SAMPLE_RATE:
+        return
+    entry = {
+        'time': time.time(),
+        'method': method,
+        'ms': round(elapsed * 1000, 2),
+        'error': error_code,
+    }
+    if detail is not None:
+        entry['detail'] = detail
+    try:
+        _log_queue.put_nowait(entry)
+    except Full:
+        log_counters['dropped'] += 1
+
+
+def _write(fd, data):
+    while data:
+        wait_write(fd)
+        data = data[os.write(fd, data[:PIPE_BUF]):]
+
+
+def _write_log():
+    sys.stdout.flush()
+    fd = sys.stdout.fileno()
+    while True:
+        entries = [_log_queue.get()]
+        while not _log_queue.empty():
+            entries.append(_log_queue.get_nowait())
+        _write(fd, ''.join(simplejson.dumps(e) + '\n' for e in entries))
+        log_counters['logged'] += len(entries)
+
+
+def start():
+    global _log_greenlet
+    if _log_greenlet is None:
+        _log_greenlet = gevent.spawn(_write_log)
+
+
+def stop():
+    global _log_greenlet
+    if _log_greenlet is not None:
+        _log_greenlet.kill()
+        _log_greenlet = None
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+        for k, v in labels),)
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help, samples):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in samples:
+            self.lines.append('%s%s %s' % (name, _format_labels(labels),
+                value))
+
+    def summary(self, name, help, samples):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s summary' % (name,))
+        for labels, count, total in samples:
+            self.lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                total))
+            self.lines.append('%s_count%s %s' % (name, _format_labels(labels),
+                count))
+
+    def histogram(self, name, help, histograms):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s histogram' % (name,))
+        for labels, histogram in histograms:
+            total = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                total += count
+                self.lines.append('%s_bucket%s %s' % (name,
+                    _format_labels(labels + [('le', bound)]), total))
+            self.lines.append('%s_bucket%s %s' % (name,
+                _format_labels(labels + [('le', '+Inf')]), histogram.count))
+            self.lines.append('%s_sum%s %s' % (name, _format_labels(labels),
+                histogram.sum))
+            self.lines.append('%s_count%s %s' % (name, _format_labels(labels),
+                histogram.count))
+
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    w = _Writer()
+    w.metric('clutchrpc_calls_total', 'counter', 'RPC calls by method.',
+        [([('method', m)], n) for m, n in sorted(calls.iteritems())])
+    w.metric('clutchrpc_errors_total', 'counter',
+        'RPC calls that returned an error, by method and error code.',
+        [([('method', m), ('code', c)], n)
+            for (m, c), n in sorted(errors.iteritems())])
+    w.histogram('clutchrpc_call_duration_seconds',
+        'Time taken to handle RPC calls, by method.',
+        [([('method', m)], h) for m, h in sorted(latencies.iteritems())])
+
+    limiters = [([('method', m)], l.stats())
+        for m, l in sorted(limits.method_limiters.iteritems())]
+    limiters.append(([('method', '_bulk')], limits.bulk_limiter.stats()))
+    limiters.append(([('method', '_spool')], limits.spool_limiter.stats()))
+    w.metric('clutchrpc_calls_running', 'gauge',
+        'RPC calls running, by method.  _bulk covers bulk calls writing to '
+        'the database and _spool the spooled batches being applied.',
+        [(labels, s['running']) for labels, s in limiters])
+    w.metric('clutchrpc_calls_waiting', 'gauge',
+        'RPC calls waiting for their turn, by method.',
+        [(labels, s['waiting']) for labels, s in limiters])
+    w.metric('clutchrpc_calls_rejected_total', 'counter',
+        'RPC calls turned away because the server was busy, by method.',
+        [(labels, s['rejected']) for labels, s in limiters])
+
+    w.metric('clutchrpc_db_pool_connections', 'gauge',
+        'Open database connections in the pool.', [([], pool.size)])
+    w.metric('clutchrpc_db_pool_in_use', 'gauge',
+        'Database connections currently checked out of the pool.',
+        [([], pool.size - pool.pool.qsize())])
+    w.metric('clutchrpc_db_pool_waits_total', 'counter',
+        'Times a caller had to wait for a free database connection.',
+        [([], pool.waits)])
+    w.metric('clutchrpc_db_pool_wait_seconds_total', 'counter',
+        'Time spent waiting for a free database connection.',
+        [([], pool.wait_time)])
+
+    timings = sorted(storage.timings.iteritems())
+    w.summary('clutchrpc_storage_duration_seconds',
+        'Time taken by storage operations.',
+        [([('op', op)], count, total) for op, (count, total, slowest)
+            in timings])
+    w.metric('clutchrpc_storage_duration_seconds_max', 'gauge',
+        'Slowest storage operation so far.',
+        [([('op', op)], slowest) for op, (count, total, slowest) in timings])
+
+    caches = [
+        ('app_keys', db.app_keys.stats()),
+        ('known_devices', db.known_devices.stats()),
+        ('signed_urls', storage.signed_urls.stats()),
+    ]
+    version_stats = framework.version_cache.stats()
+    caches.append(('versions', dict(version_stats, hits=(
+        version_stats['local_hits'] + version_stats['shared_hits'] +
+        version_stats['negative_hits']))))
+    w.metric('clutchrpc_cache_hits_total', 'counter', 'Cache hits.',
+        [([('cache', name)], s['hits']) for name, s in caches])
+    w.metric('clutchrpc_cache_misses_total', 'counter', 'Cache misses.',
+        [([('cache', name)], s['misses']) for name, s in caches])
+    w.metric('clutchrpc_cache_size', 'gauge', 'Entries held in each cache.',
+        [([('cache', name)], s['size']) for name, s in caches])
+
+    w.metric('clutchrpc_view_increments_total', 'counter',
+        'View counter increments buffered in memory, by what became of them.',
+        [([('status', k)], v) for k, v
+            in sorted(db.view_aggregator.counters.iteritems())
+            if k != 'pending'])
+    w.metric('clutchrpc_view_increments_pending', 'gauge',
+        'View counter increments waiting to be written out.',
+        [([], db.view_aggregator.counters['pending'])])
+
+    w.metric('clutchrpc_sketch_writes_total', 'counter',
+        'Unique user sketches merged in memory, by what became of them.',
+        [([('status', k)], v) for k, v
+            in sorted(db.sketch_aggregator.counters.iteritems())
+            if k != 'pending'])
+    w.metric('clutchrpc_sketch_writes_pending', 'gauge',
+        'Unique user sketches waiting to be written out.',
+        [([], db.sketch_aggregator.counters['pending'])])
+
+    spool_stats = spool.spool.stats()
+    w.metric('clutchrpc_spool_bytes', 'gauge',
+        'Bytes of log batches in the spool waiting to be applied.',
+        [([], spool_stats['size'])])
+    w.metric('clutchrpc_spool_segments', 'gauge',
+        'Spool segments queued up to be applied.',
+        [([], spool_stats['segments'])])
+    w.metric('clutchrpc_spool_dead_batches_total', 'counter',
+        'Spooled log batches given up on and moved to a .dead file.',
+        [([], spool_stats['dead'])])
+
+    w.metric('clutchrpc_ab_goals_total', 'counter',
+        'A/B goals applied to trials.', [([], db.goal_counters['goals'])])
+    w.metric('clutchrpc_ab_unmatched_goals_total', 'counter',
+        'A/B goals that had no trial to apply to.',
+        [([], db.goal_counters['unmatched'])])
+    w.metric('clutchrpc_log_entries_total', 'counter',
+        'Call log entries written or dropped.',
+        [([('status', k)], v) for k, v in sorted(log_counters.iteritems())])
+    return '\n'.join(w.lines) + '\n'
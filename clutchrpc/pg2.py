@@ -22,6 +22,7 @@
 
 import sys
 import contextlib
+import time
 
 import gevent
 from gevent.queue import Queue
@@ -58,11 +59,25 @@ class DatabaseConnectionPool(object):
         self.maxsize = maxsize
         self.pool = Queue()
         self.size = 0
+        # How many times, and for how long in total, callers had to wait for
+        # a connection to be returned to the pool
+        self.waits = 0
+        self.wait_time = 0.0
+        # Maps each greenlet running a transaction to its connection and the
+        # callbacks to run once it commits
+        self.transactions = {}
 
     def get(self):
         pool = self.pool
         if self.size >= self.maxsize or pool.qsize():
-            return pool.get()
+            if pool.qsize():
+                return pool.get()
+            start = time.time()
+            try:
+                return pool.get()
+            finally:
+                self.waits += 1
+                self.wait_time += time.time() - start
         else:
             self.size += 1
             try:
@@ -112,10 +127,63 @@ class DatabaseConnectionPool(object):
                     conn.set_isolation_level(isolation_level)
                 self.put(conn)
 
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Runs everything that the current greenlet does through the pool until
+        the end of the block in one transaction on one connection.  Each
+        cursor taken in the meantime gets a savepoint, so a statement that
+        fails can be caught and retried without losing the rest.
+        """
+        current = gevent.getcurrent()
+        if current in self.transactions:
+            yield
+            return
+        callbacks = []
+        with self.connection() as conn:
+            self.transactions[current] = (conn, callbacks)
+            try:
+                yield
+            finally:
+                del self.transactions[current]
+        for func, args in callbacks:
+            func(*args)
+
+    def in_transaction(self):
+        return gevent.getcurrent() in self.transactions
+
+    def on_commit(self, func, *args):
+        """
+        Calls ``func`` once the current greenlet's transaction has committed,
+        and not at all if it is rolled back, or straight away if there isn't
+        one.
+        """
+        transaction = self.transactions.get(gevent.getcurrent())
+        if transaction is None:
+            func(*args)
+        else:
+            transaction[1].append((func, args))
+
+    @contextlib.contextmanager
+    def _savepoint(self, conn, *args, **kwargs):
+        cursor = conn.cursor(*args, **kwargs)
+        cursor.execute('SAVEPOINT pg2')
+        try:
+            yield cursor
+        except:
+            cursor.execute('ROLLBACK TO SAVEPOINT pg2')
+            raise
+        cursor.execute('RELEASE SAVEPOINT pg2')
+
     @contextlib.contextmanager
     def cursor(self, *args, **kwargs):
         isolation_level = kwargs.pop('isolation_level', None)
         kwargs.setdefault('cursor_factory', extras.DictCursor)
+        transaction = self.transactions.get(gevent.getcurrent())
+        if transaction is not None:
+            with self._savepoint(transaction[0], *args, **kwargs) as cursor:
+                yield cursor
+            return
         conn = self.get()
         try:
             if isolation_level is not None:
@@ -0,0 +1,270 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+An append-only spool on local disk for ingest batches that can be applied to
+the database later.
+
+Batches are appended to the current segment file as JSON lines, and callers
+are only acknowledged once a periodic fsync has covered their write, so many
+concurrent appends share one fsync.  If the write or the fsync fails, callers
+are told to apply their batches themselves.  Full or idle segments are renamed
+from ``.open`` to ``.ready`` and handed to a pool of drain workers, which
+apply each batch and delete the segment once every batch in it has been
+applied.
+
+Batches are checked before they are appended, but any that still fail to
+apply are written back to their segment on their own and retried later.  Each
+batch is applied in one transaction, so one that failed has left nothing
+behind, and its retry isn't taken for a repeat of logs already recorded.  A
+batch that was applied but still in its segment when the process died is
+skipped as a repeat on the next run.  Batches that have failed
+CLUTCH_RPC_SPOOL_MAX_ATTEMPTS times are moved to a ``.dead`` file next to the
+segments, which is kept for someone to look at and doesn't count towards the
+spool's size.
+"""
+
+import os
+import time
+
+import gevent
+import simplejson
+
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+
+from clutch import settings
+
+from clutchrpc import db
+from clutchrpc import limits
+from clutchrpc import utils
+
+SPOOL_DIR = getattr(settings, 'CLUTCH_RPC_SPOOL_DIR', None)
+SPOOL_MAX_SIZE = getattr(settings, 'CLUTCH_RPC_SPOOL_MAX_SIZE', 512 * 1024 * 1024)
+SPOOL_WORKERS = getattr(settings, 'CLUTCH_RPC_SPOOL_WORKERS', 4)
+SPOOL_FSYNC_INTERVAL = getattr(settings, 'CLUTCH_RPC_SPOOL_FSYNC_INTERVAL', 0.05)
+SPOOL_MAX_ATTEMPTS = getattr(settings, 'CLUTCH_RPC_SPOOL_MAX_ATTEMPTS', 10)
+
+
+class Spool(object):
+
+    def __init__(self, path, handlers, max_size=SPOOL_MAX_SIZE,
+        workers=SPOOL_WORKERS, fsync_interval=SPOOL_FSYNC_INTERVAL,
+        segment_size=4 * 1024 * 1024, segment_age=1, retry_interval=5,
+        max_attempts=SPOOL_MAX_ATTEMPTS):
+        self.path = path
+        self.handlers = handlers
+        self.max_size = max_size
+        self.workers = workers
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        self.dead = 0
+        self.queue = Queue()
+        self.greenlets = []
+        self.started = False
+        self.size = 0
+        self.seq = 0
+        self.fd = None
+        self.segment = None
+        self.segment_bytes = 0
+        self.segment_opened = 0
+        self.dirty = False
+        self.synced = AsyncResult()
+
+    def start(self):
+        """
+        Queues up any segments left over from a previous run and starts the
+        fsync loop and the drain workers.
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        for name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, name)
+            if name.endswith('.open'):
+                os.rename(path, path[:-len('.open')] + '.ready')
+                path = path[:-len('.open')] + '.ready'
+            elif not name.endswith('.ready'):
+                continue
+            self.size += os.path.getsize(path)
+            self.queue.put(path)
+        self.greenlets.append(gevent.spawn(self._sync_loop))
+        for i in xrange(self.workers):
+            self.greenlets.append(gevent.spawn(self._drain))
+        self.started = True
+
+    def stop(self):
+        """
+        Makes everything appended so far durable.  Segments that have not been
+        drained yet are left on disk and picked up by the next ``start``.
+        """
+        if not self.started:
+            return
+        self.started = False
+        gevent.killall(self.greenlets)
+        self.greenlets = []
+        self._sync(rotate=True)
+
+    def append(self, kind, args):
+        """
+        Appends a batch for the handler named ``kind`` and blocks until it is
+        on disk.  Returns False without doing anything if the spool is not
+        running or is over its size limit, in which case the caller should
+        apply the batch itself.
+        """
+        if not self.started or self.size >= self.max_size:
+            return False
+        line = simplejson.dumps([kind, args]) + '\n'
+        try:
+            if self.fd is None:
+                self._open_segment()
+            os.write(self.fd, line)
+        except OSError:
+            utils.exception_printer(None)
+            return False
+        self.size += len(line)
+        self.segment_bytes += len(line)
+        self.dirty = True
+        try:
+            self.synced.get()
+        except OSError:
+            # The batch may still be applied from the segment, in which case
+            # the caller's copy is skipped as a repeat.
+            return False
+        return True
+
+    def _open_segment(self):
+        self.seq += 1
+        name = '%015d-%06d' % (int(time.time() * 1000), self.seq)
+        self.segment = os.path.join(self.path, name)
+        self.fd = os.open(self.segment + '.open',
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        self.segment_bytes = 0
+        self.segment_opened = time.time()
+
+    def _sync_loop(self):
+        while True:
+            gevent.sleep(self.fsync_interval)
+            try:
+                self._sync()
+            except OSError:
+                utils.exception_printer(None)
+
+    def _sync(self, rotate=False):
+        if self.fd is None:
+            return
+        if self.dirty:
+            synced, self.synced = self.synced, AsyncResult()
+            self.dirty = False
+            try:
+                os.fsync(self.fd)
+            except OSError, e:
+                synced.set_exception(e)
+                raise
+            synced.set(True)
+        if (rotate or self.segment_bytes >= self.segment_size or
+            time.time() - self.segment_opened >= self.segment_age):
+            os.close(self.fd)
+            os.rename(self.segment + '.open', self.segment + '.ready')
+            self.queue.put(self.segment + '.ready')
+            self.fd = None
+
+    def _drain(self):
+        while True:
+            path = self.queue.get()
+            try:
+                failed = self._apply(path)
+            except Exception:
+                utils.exception_printer(None)
+                gevent.sleep(self.retry_interval)
+                self.queue.put(path)
+                continue
+            size = os.path.getsize(path)
+            if not failed:
+                os.unlink(path)
+                self.size -= size
+                self.attempts.pop(path, None)
+                continue
+            attempts = self.attempts.pop(path, 0) + 1
+            if attempts >= self.max_attempts:
+                self._write(path[:-len('.ready')] + '.dead', failed)
+                os.unlink(path)
+                self.size -= size
+                self.dead += len(failed)
+                continue
+            # Only the batches that failed are retried
+            self.attempts[path] = attempts
+            self._write(path, failed)
+            self.size -= size - os.path.getsize(path)
+            gevent.sleep(self.retry_interval)
+            self.queue.put(path)
+
+    def _apply(self, path):
+        """
+        Applies each batch in the segment, and returns the lines holding the
+        batches that failed.
+        """
+        failed = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    kind, args = simplejson.loads(line)
+                except ValueError:
+                    # A torn write from a crash in the middle of an append,
+                    # which was never acknowledged to the device.
+                    continue
+                try:
+                    with limits.spool_limiter.hold():
+                        self.handlers[kind](*args)
+                except Exception:
+                    utils.exception_printer(None)
+                    failed.append(line)
+        return failed
+
+    def _write(self, path, lines):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'segments': self.queue.qsize(),
+            'dead': self.dead,
+        }
+
+
+spool = Spool(SPOOL_DIR, {
+    'stats': db.apply_atomically(db.add_bulk_stats_logs),
+    'ab': db.apply_atomically(db.add_bulk_ab_logs),
+})
+
+
+def start():
+    if SPOOL_DIR:
+        spool.start()
+
+
+def stop():
+    spool.stop()
+
+
+def append(kind, args):
+    return spool.append(kind, args)
@@ -0,0 +1,302 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Where the RPC server keeps uploaded app files, named like
+``<app slug>/<version>/files/<filename>``.
+
+With CLUTCH_RPC_CONTENT_ADDRESSED set, each distinct file is instead stored
+once per app as ``<app slug>/objects/<md5>``, and each version only gets an
+index at ``<app slug>/<version>/meta/objects.json`` mapping its filenames to
+those hashes.  Versions uploaded before the setting was turned on have no
+index and keep working as before.
+
+Files live in the S3 bucket from the AWS_* settings, or in a local directory
+if CLUTCH_RPC_STORAGE_DIR is set, which is handy for benchmarks, tests and
+machines that can't reach S3.  Everything goes through the module-level
+functions, which record how long each kind of operation takes.
+"""
+
+import contextlib
+import mimetypes
+import os
+import shutil
+import time
+import urllib
+
+from boto.exception import S3ResponseError
+from boto.s3.connection import S3Connection
+from boto.s3.key import Key
+from gevent.queue import Queue
+
+from clutch import settings
+
+from clutchrpc.cache import TTLCache
+
+STORAGE_DIR = getattr(settings, 'CLUTCH_RPC_STORAGE_DIR', None)
+
+# The URL that the files in STORAGE_DIR are served from, if any
+STORAGE_URL = getattr(settings, 'CLUTCH_RPC_STORAGE_URL', None)
+
+CONTENT_ADDRESSED = getattr(settings, 'CLUTCH_RPC_CONTENT_ADDRESSED', False)
+
+# When set, app files are linked to at this URL, such as that of a CDN in
+# front of the bucket, instead of by signed URLs.  Stored app files never
+# change, so they are stored with headers that let them be cached forever.
+PUBLIC_URL = getattr(settings, 'CLUTCH_RPC_PUBLIC_URL', None)
+
+# How many seconds the signed URLs handed out for app files are valid for,
+# and how long before then to stop handing out the same one.
+SIGNED_URL_EXPIRES = getattr(settings, 'CLUTCH_RPC_SIGNED_URL_EXPIRES', 3600)
+SIGNED_URL_MARGIN = getattr(settings, 'CLUTCH_RPC_SIGNED_URL_MARGIN', 300)
+SIGNED_URL_CACHE_MAX_SIZE = getattr(settings,
+    'CLUTCH_RPC_SIGNED_URL_CACHE_MAX_SIZE', 20000)
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000'
+
+# How many S3 connections to keep open at most
+S3_POOL_SIZE = getattr(settings, 'CLUTCH_RPC_S3_POOL_SIZE', 20)
+
+
+class S3Storage(object):
+    """
+    Stores files in an S3 bucket, using a pool of connections that are kept
+    open and shared by all greenlets, one greenlet at a time.
+    """
+
+    def __init__(self, access_key, secret, bucket_name, max_size=S3_POOL_SIZE):
+        self.access_key = access_key
+        self.secret = secret
+        self.bucket_name = bucket_name
+        self.max_size = max_size
+        self.pool = Queue()
+        self.size = 0
+
+    def _create_bucket(self):
+        conn = S3Connection(self.access_key, self.secret)
+        return conn.get_bucket(self.bucket_name, validate=False)
+
+    @contextlib.contextmanager
+    def bucket(self):
+        if self.size >= self.max_size or self.pool.qsize():
+            bucket = self.pool.get()
+        else:
+            self.size += 1
+            try:
+                bucket = self._create_bucket()
+            except:
+                self.size -= 1
+                raise
+        try:
+            yield bucket
+        finally:
+            self.pool.put(bucket)
+
+    def get(self, name):
+        with self.bucket() as bucket:
+            try:
+                return Key(bucket, name).get_contents_as_string()
+            except S3ResponseError, e:
+                if e.status == 404:
+                    return None
+                raise
+
+    def exists(self, name):
+        with self.bucket() as bucket:
+            return bucket.get_key(name) is not None
+
+    def _get_headers(self, content_type, immutable):
+        headers = {}
+        if content_type:
+            headers['Content-Type'] = content_type
+        if immutable:
+            headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return headers
+
+    def put(self, name, data, content_type=None, immutable=False):
+        headers = self._get_headers(content_type, immutable)
+        with self.bucket() as bucket:
+            bucket.new_key(name).set_contents_from_string(data, headers)
+
+    def put_file(self, name, f, content_type=None, immutable=False):
+        headers = self._get_headers(content_type, immutable)
+        with self.bucket() as bucket:
+            bucket.new_key(name).set_contents_from_file(f, headers)
+
+    def get_url(self, name, expires_in):
+        with self.bucket() as bucket:
+            return Key(bucket, name).generate_url(expires_in)
+
+
+class LocalStorage(object):
+    """
+    Stores files under a local directory, served from ``url`` if it is given.
+    """
+
+    def __init__(self, root, url=None):
+        self.root = os.path.abspath(root)
+        self.url = url
+
+    def _get_path(self, name):
+        path = os.path.abspath(os.path.join(self.root, *name.split('/')))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError('Invalid storage name: %r' % (name,))
+        return path
+
+    def get(self, name):
+        path = self._get_path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def exists(self, name):
+        return os.path.exists(self._get_path(name))
+
+    def put(self, name, data, content_type=None, immutable=False):
+        path = self._get_path(name)
+        with self._open(path) as f:
+            f.write(data)
+
+    def put_file(self, name, f, content_type=None, immutable=False):
+        path = self._get_path(name)
+        with self._open(path) as out:
+            shutil.copyfileobj(f, out)
+
+    @contextlib.contextmanager
+    def _open(self, path):
+        # Written under a temporary name, so that nobody sees half a file
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            yield f
+        os.rename(tmp, path)
+
+    def get_url(self, name, expires_in):
+        if self.url:
+            return self.url.rstrip('/') + '/' + urllib.quote(name)
+        return 'file://' + urllib.pathname2url(self._get_path(name))
+
+
+if STORAGE_DIR:
+    backend = LocalStorage(STORAGE_DIR, STORAGE_URL)
+else:
+    backend = S3Storage(settings.AWS_ACCESS_KEY, settings.AWS_ACCESS_SECRET,
+        settings.AWS_BUCKET_NAME)
+
+# Maps each operation to its count, total and slowest time in seconds
+timings = {}
+
+
+def _timed(op):
+    def decorator(func):
+        def _inner(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                timing = timings.setdefault(op, [0, 0.0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+        return _inner
+    return decorator
+
+
+@_timed('get')
+def get(name):
+    """
+    Returns the contents of the named file, or None if there is no such file.
+    """
+    return backend.get(name)
+
+
+@_timed('exists')
+def exists(name):
+    return backend.exists(name)
+
+
+@_timed('put')
+def put(name, data, content_type=None, immutable=False):
+    """
+    Stores ``data`` under the given name, with the given content type or else
+    one guessed from the name.  Pass ``immutable`` for files that will never
+    change, so that they can be cached forever once downloaded.
+    """
+    if content_type is None:
+        content_type = mimetypes.guess_type(name)[0]
+    backend.put(name, data, content_type, immutable)
+
+
+@_timed('put')
+def put_file(name, f, content_type=None, immutable=False):
+    """
+    Like ``put``, but stores what is left to read of the file object ``f``
+    without reading it all into memory first.
+    """
+    if content_type is None:
+        content_type = mimetypes.guess_type(name)[0]
+    backend.put_file(name, f, content_type, immutable)
+
+
+@_timed('get_url')
+def get_url(name, expires_in):
+    """
+    Returns a URL that the named file can be downloaded from for at least
+    ``expires_in`` seconds.
+    """
+    return backend.get_url(name, expires_in)
+
+
+signed_urls = TTLCache(SIGNED_URL_CACHE_MAX_SIZE,
+    SIGNED_URL_EXPIRES - SIGNED_URL_MARGIN)
+
+
+def get_file_url(name):
+    """
+    Returns a URL for a stored app file, which must be one that never
+    changes.  Signed URLs are reused until shortly before they expire, so
+    that devices and proxies can cache the download.
+    """
+    if PUBLIC_URL:
+        return PUBLIC_URL.rstrip('/') + '/' + urllib.quote(name)
+    url = signed_urls.get(name)
+    if url is None:
+        url = get_url(name, SIGNED_URL_EXPIRES)
+        signed_urls.set(name, url)
+    return url
+
+
+def get_object_name(app_slug, digest):
+    return '%s/objects/%s' % (app_slug, digest)
+
+
+def get_index_name(app_slug, app_version):
+    return '%s/%s/meta/objects.json' % (app_slug, app_version)
+
+
+def get_bundle_name(app_slug, app_version):
+    return '%s/%s/meta/bundle.zip' % (app_slug, app_version)
+
+
+def stats():
+    return dict((op, {
+        'count': count,
+        'total': total,
+        'mean': total / count if count else 0.0,
+        'max': slowest,
+    }) for op, (count, total, slowest) in timings.iteritems())
@@ -0,0 +1,569 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests for the parts of the RPC server that don't need a database.  Run them
+with ``python -m clutchrpc.tests``.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from StringIO import StringIO
+
+import gevent
+import simplejson
+
+from clutchrpc import app
+from clutchrpc import listener
+from clutchrpc import utils
+from clutchrpc.aggregator import CounterAggregator, SketchAggregator
+from clutchrpc.cache import ImmutableCache, TTLCache
+from clutchrpc.limits import Limiter
+from clutchrpc.spool import Spool
+from clutchrpc.storage import LocalStorage
+
+PAYLOAD = {
+    'method': 'stats',
+    'id': 1,
+    'params': {'logs': [{
+        'uuid': '5b1f7c2e-0d4c-11e2-9e96-0800200c9a66',
+        'ts': 1349312400.123456,
+        'action': 'viewDidAppear',
+        'data': {'slug': u'caf\xe9', 'count': 3, 'seen': True,
+            'parent': None},
+    }]},
+}
+
+
+class CodecTest(unittest.TestCase):
+    def test_json_round_trip(self):
+        self.assertEqual(utils.JSON.loads(utils.JSON.dumps(PAYLOAD)), PAYLOAD)
+
+    def test_msgpack_round_trip(self):
+        if utils.msgpack is None:
+            return
+        data = utils.MSGPACK.dumps(PAYLOAD)
+        self.assertTrue(isinstance(data, str))
+        decoded = utils.MSGPACK.loads(data)
+        self.assertEqual(decoded, PAYLOAD)
+        # Strings come back as unicode, as they do from JSON
+        self.assertTrue(isinstance(decoded['method'], unicode))
+        self.assertTrue(isinstance(decoded['params']['logs'][0]['uuid'],
+            unicode))
+
+    def test_codec_from_content_type(self):
+        if utils.msgpack is None:
+            return
+        env = {'CONTENT_TYPE': 'application/x-msgpack; charset=binary'}
+        self.assertTrue(utils.get_request_codec(env) is utils.MSGPACK)
+        self.assertTrue(utils.get_request_codec({}) is utils.JSON)
+
+
+def _wait_for(condition, timeout=2):
+    """
+    Yields to other greenlets until ``condition()`` is true, failing if that
+    takes longer than ``timeout`` seconds.
+    """
+    with gevent.Timeout(timeout):
+        while not condition():
+            gevent.sleep(0.01)
+
+
+class QuietTestCase(unittest.TestCase):
+    """
+    Keeps the tracebacks that the code under test logs for failures it
+    expects out of the test output.
+    """
+
+    def setUp(self):
+        self.exception_printer = utils.exception_printer
+        utils.exception_printer = lambda sender, **kwargs: None
+
+    def tearDown(self):
+        utils.exception_printer = self.exception_printer
+
+
+class CounterAggregatorTest(QuietTestCase):
+    def setUp(self):
+        QuietTestCase.setUp(self)
+        self.flushed = []
+        self.fail_flush = False
+
+    def flush(self, table, columns, counts):
+        if self.fail_flush:
+            raise ValueError('database is down')
+        self.flushed.append((table, columns, dict(counts)))
+
+    def test_flush(self):
+        aggregator = CounterAggregator(self.flush, interval=3600)
+        aggregator.add('views', ('slug',), {('a',): 2, ('b',): 1})
+        aggregator.add('views', ('slug',), {('a',): 1})
+        self.assertEqual(aggregator.counters['pending'], 4)
+        aggregator.flush()
+        self.assertEqual(self.flushed,
+            [('views', ('slug',), {('a',): 3, ('b',): 1})])
+        self.assertEqual(aggregator.counters['pending'], 0)
+        self.assertEqual(aggregator.counters['flushed'], 4)
+        aggregator.stop()
+        self.assertEqual(len(self.flushed), 1)
+
+    def test_flush_at_max_keys(self):
+        aggregator = CounterAggregator(self.flush, interval=3600, max_keys=2)
+        aggregator.add('views', ('slug',), {('a',): 1})
+        gevent.sleep(0)
+        self.assertEqual(self.flushed, [])
+        aggregator.add('views', ('slug',), {('b',): 1})
+        _wait_for(lambda: self.flushed)
+        self.assertEqual(aggregator.counters['flushed'], 2)
+        aggregator.stop()
+
+    def test_requeue(self):
+        aggregator = CounterAggregator(self.flush, interval=3600)
+        aggregator.add('views', ('slug',), {('a',): 2})
+        self.fail_flush = True
+        aggregator.flush()
+        self.assertEqual(aggregator.counters['deferred'], 2)
+        self.assertEqual(aggregator.counters['pending'], 2)
+        aggregator.add('views', ('slug',), {('a',): 1})
+        self.fail_flush = False
+        aggregator.flush()
+        self.assertEqual(self.flushed, [('views', ('slug',), {('a',): 3})])
+        self.assertEqual(aggregator.counters['flushed'], 3)
+        self.assertEqual(aggregator.counters['lost'], 0)
+        aggregator.stop()
+
+    def test_overflow(self):
+        aggregator = CounterAggregator(self.flush, interval=3600,
+            max_pending=1)
+        aggregator.add('views', ('slug',), {('a',): 2, ('b',): 3})
+        self.fail_flush = True
+        aggregator.flush()
+        self.assertEqual(aggregator.counters['lost'], 5)
+        self.assertEqual(aggregator.counters['deferred'], 0)
+        self.assertEqual(aggregator.counters['pending'], 0)
+        self.fail_flush = False
+        aggregator.stop()
+        self.assertEqual(self.flushed, [])
+
+
+class SketchAggregatorTest(QuietTestCase):
+    def test_merge_and_requeue(self):
+        flushed = []
+        failures = [ValueError('database is down')]
+
+        def flush(sketches):
+            if failures:
+                raise failures.pop()
+            flushed.append(sketches)
+
+        aggregator = SketchAggregator(flush, interval=3600)
+        aggregator.add('key', 3, 2, False)
+        aggregator.add('key', 3, 5, True)
+        aggregator.add('key', 3, 4, True)
+        aggregator.flush()
+        self.assertEqual(aggregator.counters['deferred'], 1)
+        aggregator.flush()
+        self.assertEqual(flushed, [{'key': ({3: 5}, {3: 5})}])
+        self.assertEqual(aggregator.counters['flushed'], 1)
+        self.assertEqual(aggregator.counters['pending'], 0)
+        aggregator.stop()
+
+
+class SpoolTest(QuietTestCase):
+    def setUp(self):
+        QuietTestCase.setUp(self)
+        self.path = tempfile.mkdtemp()
+        self.applied = []
+        self.failing = False
+        self.spool = None
+
+    def tearDown(self):
+        if self.spool is not None:
+            self.spool.stop()
+        shutil.rmtree(self.path)
+        QuietTestCase.tearDown(self)
+
+    def handler(self, *args):
+        if self.failing:
+            raise ValueError('database is down')
+        self.applied.append(list(args))
+
+    def start(self, **kwargs):
+        kwargs.setdefault('fsync_interval', 0.01)
+        kwargs.setdefault('retry_interval', 0)
+        self.spool = Spool(self.path, {'stats': self.handler}, **kwargs)
+        self.spool.start()
+        return self.spool
+
+    def get_files(self, suffix):
+        return [n for n in os.listdir(self.path) if n.endswith(suffix)]
+
+    def test_not_started(self):
+        spool = Spool(self.path, {'stats': self.handler})
+        self.assertFalse(spool.append('stats', [1]))
+
+    def test_over_max_size(self):
+        spool = self.start(workers=0, max_size=1)
+        self.assertTrue(spool.append('stats', [1]))
+        self.assertFalse(spool.append('stats', [2]))
+
+    def test_rotation(self):
+        spool = self.start(workers=0, segment_size=30, segment_age=3600)
+        self.assertTrue(spool.append('stats', ['a' * 40]))
+        _wait_for(lambda: self.get_files('.ready'))
+        self.assertEqual(self.get_files('.open'), [])
+        self.assertTrue(spool.append('stats', ['b']))
+        self.assertEqual(len(self.get_files('.open')), 1)
+        self.assertEqual(spool.stats()['segments'], 1)
+
+    def test_drain(self):
+        spool = self.start(workers=1, segment_age=0)
+        self.assertTrue(spool.append('stats', [1, 'a']))
+        self.assertTrue(spool.append('stats', [2, 'b']))
+        _wait_for(lambda: len(self.applied) == 2)
+        _wait_for(lambda: spool.size == 0)
+        self.assertEqual(self.applied, [[1, 'a'], [2, 'b']])
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_torn_line(self):
+        # Left over from a crash in the middle of an append
+        with open(os.path.join(self.path, '1-1.open'), 'w') as f:
+            f.write('["stats", [1]]\n["stats", [2')
+        self.start(workers=1)
+        _wait_for(lambda: not os.listdir(self.path))
+        self.assertEqual(self.applied, [[1]])
+
+    def test_dead(self):
+        with open(os.path.join(self.path, '1-1.ready'), 'w') as f:
+            f.write('["stats", [1]]\n')
+        self.failing = True
+        spool = self.start(workers=1, max_attempts=2)
+        _wait_for(lambda: self.get_files('.dead'))
+        self.assertEqual(self.get_files('.ready'), [])
+        with open(os.path.join(self.path, '1-1.dead')) as f:
+            self.assertEqual(f.read(), '["stats", [1]]\n')
+        self.assertEqual(spool.stats()['dead'], 1)
+        self.assertEqual(spool.size, 0)
+        self.assertEqual(self.applied, [])
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_expiry(self):
+        cache = TTLCache(10, 60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=0)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'missing'), 'missing')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_generation(self):
+        cache = TTLCache(10, 60)
+        generation = cache.generation
+        cache.delete('a')
+        # Looked up before the delete, so it may be stale
+        cache.set('a', 1, generation=generation)
+        self.assertEqual(cache.get('a'), None)
+        cache.set('a', 2, generation=cache.generation)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_max_size(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1, ttl=0)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.get('c'), 3)
+        cache.set('d', 4)
+        self.assertEqual(cache.stats()['size'], 1)
+        self.assertEqual(cache.get('d'), 4)
+
+
+class ImmutableCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def fetch(self, value):
+        self.calls.append(value)
+        gevent.sleep(0.01)
+        return value
+
+    def test_cached(self):
+        cache = ImmutableCache(10)
+        self.assertEqual(cache.get('key', self.fetch, 'value'), 'value')
+        self.assertEqual(cache.get('key', self.fetch, 'value'), 'value')
+        self.assertEqual(self.calls, ['value'])
+        self.assertEqual(cache.counters['local_hits'], 1)
+
+    def test_none_not_cached(self):
+        cache = ImmutableCache(10)
+        self.assertEqual(cache.get('key', self.fetch, None), None)
+        self.assertEqual(cache.get('key', self.fetch, None), None)
+        self.assertEqual(self.calls, [None, None])
+
+    def test_negative_ttl(self):
+        cache = ImmutableCache(10, negative_ttl=60)
+        self.assertEqual(cache.get('key', self.fetch, None), None)
+        self.assertEqual(cache.get('key', self.fetch, None), None)
+        self.assertEqual(self.calls, [None])
+        self.assertEqual(cache.counters['negative_hits'], 1)
+
+    def test_single_flight(self):
+        cache = ImmutableCache(10)
+        greenlets = [gevent.spawn(cache.get, 'key', self.fetch, 'value')
+            for i in xrange(5)]
+        gevent.joinall(greenlets)
+        self.assertEqual([g.value for g in greenlets], ['value'] * 5)
+        self.assertEqual(self.calls, ['value'])
+        self.assertEqual(cache.counters['waits'], 4)
+        self.assertEqual(cache.pending, {})
+
+    def test_single_flight_error(self):
+        cache = ImmutableCache(10)
+
+        def fetch():
+            gevent.sleep(0.01)
+            raise ValueError('storage is down')
+
+        def get():
+            try:
+                return cache.get('key', fetch)
+            except ValueError, e:
+                return e
+
+        greenlets = [gevent.spawn(get) for i in xrange(3)]
+        gevent.joinall(greenlets)
+        for greenlet in greenlets:
+            self.assertTrue(isinstance(greenlet.value, ValueError))
+        self.assertEqual(cache.pending, {})
+
+
+class LimiterTest(unittest.TestCase):
+    def test_order(self):
+        limiter = Limiter(1, 10)
+        self.assertTrue(limiter.acquire(1))
+        order = []
+
+        def call(i):
+            if limiter.acquire(1):
+                order.append(i)
+                limiter.release()
+
+        greenlets = [gevent.spawn(call, i) for i in xrange(3)]
+        gevent.sleep(0)
+        self.assertEqual(limiter.stats()['waiting'], 3)
+        # Not allowed to jump the queue
+        self.assertFalse(limiter.acquire(0))
+        limiter.release()
+        gevent.joinall(greenlets)
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(limiter.stats()['running'], 0)
+
+    def test_queue_full(self):
+        limiter = Limiter(1, 1)
+        self.assertTrue(limiter.acquire(1))
+        waiter = gevent.spawn(limiter.acquire, 1)
+        gevent.sleep(0)
+        self.assertFalse(limiter.acquire(1))
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        limiter.release()
+        self.assertTrue(waiter.get())
+        limiter.release()
+        self.assertEqual(limiter.stats()['running'], 0)
+
+    def test_timeout(self):
+        limiter = Limiter(1, 1)
+        self.assertTrue(limiter.acquire(1))
+        self.assertFalse(limiter.acquire(0.01))
+        self.assertEqual(limiter.stats()['waiting'], 0)
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        limiter.release()
+        self.assertEqual(limiter.stats()['running'], 0)
+
+    def test_killed_waiter(self):
+        limiter = Limiter(1, 1)
+        self.assertTrue(limiter.acquire(1))
+        waiter = gevent.spawn(limiter.acquire, 1)
+        gevent.sleep(0)
+        waiter.kill(block=True)
+        self.assertEqual(limiter.stats()['waiting'], 0)
+        limiter.release()
+        self.assertEqual(limiter.stats()['running'], 0)
+
+    def test_hold(self):
+        limiter = Limiter(1, 0)
+        with limiter.hold():
+            self.assertEqual(limiter.stats()['running'], 1)
+        self.assertEqual(limiter.stats()['running'], 0)
+
+
+class GzipTest(unittest.TestCase):
+    def respond(self, data, env):
+        headers = []
+        body = utils.Response(data).respond(env,
+            lambda status, h: headers.extend(h))
+        return ''.join(body), dict(headers)
+
+    def test_gunzip(self):
+        data = 'x' * 1000
+        self.assertEqual(utils.gunzip(utils.gzip(data), 1000), data)
+        self.assertRaises(utils.RequestTooLarge, utils.gunzip,
+            utils.gzip(data), 999)
+        self.assertRaises(zlib.error, utils.gunzip, 'not gzip', 1000)
+
+    def test_accepts_gzip(self):
+        self.assertTrue(utils.accepts_gzip(
+            {'HTTP_ACCEPT_ENCODING': 'deflate, gzip;q=0.5'}))
+        self.assertFalse(utils.accepts_gzip(
+            {'HTTP_ACCEPT_ENCODING': 'gzip; q=0'}))
+        self.assertFalse(utils.accepts_gzip({}))
+
+    def test_threshold(self):
+        if utils.GZIP_MIN_SIZE is None:
+            return
+        env = {'HTTP_ACCEPT_ENCODING': 'gzip'}
+        small = 'x' * (utils.GZIP_MIN_SIZE - 1)
+        body, headers = self.respond(small, env)
+        self.assertEqual(body, small)
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertFalse('Vary' in headers)
+
+        large = 'x' * utils.GZIP_MIN_SIZE
+        body, headers = self.respond(large, env)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(utils.gunzip(body, len(large)), large)
+
+        body, headers = self.respond(large, {})
+        self.assertEqual(body, large)
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+
+
+class LocalStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = LocalStorage(self.root, 'http://files.example.com/')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_and_get(self):
+        self.assertEqual(self.storage.get('app/1/files/index.html'), None)
+        self.assertFalse(self.storage.exists('app/1/files/index.html'))
+        self.storage.put('app/1/files/index.html', '<html>')
+        self.assertTrue(self.storage.exists('app/1/files/index.html'))
+        self.assertEqual(self.storage.get('app/1/files/index.html'), '<html>')
+        self.storage.put('app/1/files/index.html', '<html></html>')
+        self.assertEqual(self.storage.get('app/1/files/index.html'),
+            '<html></html>')
+        self.assertEqual(os.listdir(os.path.join(self.root, 'app', '1',
+            'files')), ['index.html'])
+
+    def test_put_file(self):
+        self.storage.put_file('app/1/meta/bundle.zip', StringIO('zip' * 1000))
+        self.assertEqual(self.storage.get('app/1/meta/bundle.zip'),
+            'zip' * 1000)
+
+    def test_invalid_name(self):
+        self.assertRaises(ValueError, self.storage.put, '../outside', 'x')
+        self.assertRaises(ValueError, self.storage.get, 'app/../../outside')
+
+    def test_get_url(self):
+        self.assertEqual(self.storage.get_url('app/1/files/a b.js', 60),
+            'http://files.example.com/app/1/files/a%20b.js')
+        storage = LocalStorage(self.root)
+        self.assertTrue(storage.get_url('app/x.js', 60).startswith('file://'))
+
+
+class ListenerTest(QuietTestCase):
+    class Notify(object):
+        def __init__(self, channel, payload):
+            self.channel = channel
+            self.payload = payload
+
+    def setUp(self):
+        QuietTestCase.setUp(self)
+        self.handlers = listener.HANDLERS
+        self.keys = []
+        listener.HANDLERS = {'keys': self.handler}
+
+    def tearDown(self):
+        listener.HANDLERS = self.handlers
+        QuietTestCase.tearDown(self)
+
+    def handler(self, key):
+        self.keys.append(key)
+        if key == 'bad':
+            raise ValueError('bad key')
+
+    def test_handle(self):
+        listener._handle(self.Notify('keys', 'a'))
+        listener._handle(self.Notify('keys', ''))
+        listener._handle(self.Notify('other', 'b'))
+        self.assertEqual(self.keys, ['a', None])
+
+    def test_handler_fails(self):
+        listener._handle(self.Notify('keys', 'bad'))
+        self.assertEqual(self.keys, ['bad', None])
+
+
+class BatchErrorTest(unittest.TestCase):
+    def call(self, body, **env):
+        env.update({
+            'PATH_INFO': '/rpc/',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+        })
+        status = []
+        response = app.app(env, lambda s, headers: status.append(s))
+        return int(status[0].split()[0]), simplejson.loads(''.join(response))
+
+    def test_batch_too_large(self):
+        calls = [{'method': 'getFiles'}] * (app.MAX_BATCH_SIZE + 1)
+        code, response = self.call(simplejson.dumps(calls))
+        self.assertEqual(response['error']['code'], 17)
+
+    def test_empty_batch(self):
+        code, response = self.call('[]')
+        self.assertEqual(response['error']['code'], 19)
+
+    def test_undecodable(self):
+        code, response = self.call('{"method": ')
+        self.assertEqual(code, 400)
+        self.assertEqual(response['error']['code'], 19)
+
+    def test_invalid_gzip(self):
+        code, response = self.call('not gzip', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(code, 400)
+        self.assertEqual(response['error']['code'], 19)
+
+    def test_request_too_large(self):
+        body = utils.gzip(simplejson.dumps({'method': 'x' * 100}))
+        max_request_size = app.MAX_REQUEST_SIZE
+        app.MAX_REQUEST_SIZE = 50
+        try:
+            code, response = self.call(body, HTTP_CONTENT_ENCODING='gzip')
+        finally:
+            app.MAX_REQUEST_SIZE = max_request_size
+        self.assertEqual(code, 413)
+        self.assertEqual(response['error']['code'], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
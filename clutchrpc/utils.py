@@ -19,15 +19,99 @@ import os
 import re
 import sys
 import traceback
+import zlib
 
 from urlparse import urljoin
 
 import pytz
 import simplejson
 
+try:
+    import msgpack
+    # The pure Python implementation that msgpack falls back on without its C
+    # extension decodes many times slower than JSON, so it isn't offered.
+    if msgpack.Packer.__module__ == 'msgpack.fallback':
+        msgpack = None
+except ImportError:
+    msgpack = None
+
+try:
+    import ujson
+    # Older versions lose float precision, which would mangle timestamps
+    ujson.loads('0.5', precise_float=True)
+except (ImportError, TypeError):
+    ujson = None
+
+
+from clutch import settings
 
 ABSOLUTE_URL_RE = re.compile(r'^https?://', re.I)
 
+# Response bodies at least this many bytes long are gzipped for clients that
+# accept it.  Set to None to never compress responses.
+GZIP_MIN_SIZE = getattr(settings, 'CLUTCH_RPC_GZIP_MIN_SIZE', 1024)
+
+
+class Codec(object):
+    """
+    A wire format for RPC requests and responses.
+    """
+
+    def __init__(self, name, content_type, loads, dumps):
+        self.name = name
+        self.content_type = content_type
+        self.loads = loads
+        self.dumps = dumps
+
+
+def _get_json_codec():
+    # The fastest JSON implementation that is installed
+    if ujson is not None:
+        return Codec('ujson', 'application/json',
+            lambda data: ujson.loads(data, precise_float=True),
+            lambda obj: ujson.dumps(obj, double_precision=15))
+    if simplejson._import_c_make_encoder() is not None:
+        return Codec('simplejson', 'application/json', simplejson.loads,
+            simplejson.dumps)
+    import json
+    if json.scanner.c_make_scanner is not None:
+        return Codec('json', 'application/json', json.loads, json.dumps)
+    return Codec('simplejson', 'application/json', simplejson.loads,
+        simplejson.dumps)
+
+
+JSON = _get_json_codec()
+
+CODECS = {JSON.content_type: JSON}
+
+if msgpack is not None:
+    # raw=False decodes strings as UTF-8, and works from msgpack 0.5.2 on.
+    # Byte strings like hashes and URLs are sent as strings, not as binary.
+    MSGPACK = Codec('msgpack', 'application/x-msgpack',
+        lambda data: msgpack.unpackb(data, raw=False),
+        lambda obj: msgpack.packb(obj, use_bin_type=False))
+    CODECS[MSGPACK.content_type] = MSGPACK
+
+
+def get_request_codec(env):
+    """
+    Returns the codec for the request's Content-Type, defaulting to JSON.
+    """
+    content_type = env.get('CONTENT_TYPE') or ''
+    return CODECS.get(content_type.split(';')[0].strip().lower(), JSON)
+
+
+def get_response_codec(env):
+    """
+    Returns the first codec listed in the request's Accept header, or else
+    the one the request was sent in.
+    """
+    for accept in (env.get('HTTP_ACCEPT') or '').split(','):
+        codec = CODECS.get(accept.split(';')[0].strip().lower())
+        if codec is not None:
+            return codec
+    return get_request_codec(env)
+
 
 def get_now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
@@ -40,11 +124,40 @@ class Response(object):
         self.code = code
         self.content_type = content_type
 
+    # Any more headers to send
+    headers = ()
+
     def respond(self, env, start_response):
+        data = self.data
+        headers = [('Content-Type', self.content_type)]
+        headers.extend(self.headers)
+        if GZIP_MIN_SIZE is not None and len(data) >= GZIP_MIN_SIZE:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_gzip(env):
+                data = gzip(data)
+                headers.append(('Content-Encoding', 'gzip'))
         start_response('%s %s' % (self.code, httplib.responses[self.code]),
-            [('Content-Type', self.content_type)]
+            headers
         )
-        return [self.data]
+        return [data]
+
+
+class JSONResponse(Response):
+    """
+    A response whose body is only encoded when it is sent, in the format the
+    client asked for, so that the responses to a batch of calls can be
+    combined first.
+    """
+
+    def __init__(self, payload, code=200):
+        Response.__init__(self, None, code=code)
+        self.payload = payload
+
+    def respond(self, env, start_response):
+        codec = get_response_codec(env)
+        self.data = codec.dumps(self.payload)
+        self.content_type = codec.content_type
+        return Response.respond(self, env, start_response)
 
 
 class ResponseRedirect(Response):
@@ -84,6 +197,40 @@ class ResponseRedirect(Response):
         return ['Redirecting to ' + url]
 
 
+def accepts_gzip(env):
+    for encoding in env.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = encoding.split(';')
+        if params[0].strip().lower() != 'gzip':
+            continue
+        return not any(p.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00')
+            for p in params[1:])
+    return False
+
+
+def gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class RequestTooLarge(ValueError):
+    pass
+
+
+def gunzip(data, max_size):
+    """
+    Decompresses a gzipped request body, refusing to produce more than
+    ``max_size`` bytes so that a small body can't expand to fill memory.
+    Raises RequestTooLarge if it would, and zlib.error if the body is not
+    valid gzip.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    data = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail:
+        raise RequestTooLarge('Request body is larger than %s bytes' % (
+            max_size,))
+    return data
+
+
 def print_exception(f):
     f.write(''.join(traceback.format_exception(*sys.exc_info())) + '\n\n')
 
@@ -93,7 +240,7 @@ def exception_printer(sender, **kwargs):
 
 
 def render_json(data, code=200):
-    return Response(simplejson.dumps(data), code=code)
+    return JSONResponse(data, code=code)
     return ['Not Found\r\n']
 
 
@@ -124,6 +271,13 @@ def jsonrpc_error(request_json, error_code, data=None, code=200):
         13: 'unknown-device',
         14: 'deactivated-app-key',
         15: 'app-over-limit',
+        16: 'version-not-found',
+        17: 'batch-too-large',
+        18: 'server-busy',
+        19: 'invalid-request',
+        20: 'request-too-large',
+        21: 'invalid-logs',
+        22: 'bundle-unavailable',
     }[error_code]
     detail = {
         1: 'The method %(method)r was not specified.',
@@ -141,6 +295,13 @@ def jsonrpc_error(request_json, error_code, data=None, code=200):
         13: 'Unkown device (%(device_id)s) was specified',
         14: 'The app key that was specified was deactivated: %(app_key)s',
         15: 'The requested app is over its monthly limit',
+        16: 'The requested app version was not found: %(version)s',
+        17: 'The batch of %(size)s calls is larger than the limit of %(max_size)s',
+        18: 'The server is too busy to handle %(method)s, try again in %(retry_after)s seconds',
+        19: 'The request is not a valid JSON-RPC request: %(reason)s',
+        20: 'The request body is larger than the limit of %(max_size)s bytes',
+        21: 'The logs could not be recorded: %(problem)s',
+        22: 'The archive of app version %(version)s could not be built',
     }[error_code] % data
     return render_json({
         'id': request_json.get('id'),
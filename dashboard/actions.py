@@ -19,7 +19,7 @@ from django.db import transaction
 from django_ext.http import JSONResponse
 
 from dashboard.models import Device, AppKey, App, Member, Version
-from dashboard.utils import norm_bundle
+from dashboard.utils import norm_bundle, notify_app_key_changed
 
 
 def device_make_primary(request):
@@ -46,12 +46,14 @@ def device_delete(request):
 def key_deactivate(request):
     app_key = AppKey.objects.get(id=request.GET['app-key'])
     AppKey.objects.filter(id=app_key.id).update(status=AppKey.INACTIVE)
+    notify_app_key_changed(app_key.key)
     return None
 
 
 def key_reactivate(request):
     app_key = AppKey.objects.get(id=request.GET['app-key'])
     AppKey.objects.filter(id=app_key.id).update(status=AppKey.ACTIVE)
+    notify_app_key_changed(app_key.key)
     return None
 
 
@@ -61,6 +63,7 @@ def key_generate(request):
         app=app,
         key=str(uuid.uuid4())
     )
+    notify_app_key_changed(app_key.key)
     return {
         'app_key': app_key.data(),
     }
@@ -12,6 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from django.db import connection
+
+# The Postgres NOTIFY channel that clutchrpc.listener listens on for app keys
+# whose status has changed.
+APP_KEY_CHANNEL = 'clutch_app_key'
+
 
 def norm_bundle(s):
     split_bundle = s.split('.')
@@ -19,3 +25,13 @@ def norm_bundle(s):
         raise ValueError('Bundle is not three points')
     split_bundle = map(int, split_bundle)
     return '.'.join([str(i).zfill(5) for i in split_bundle])
+
+
+def notify_app_key_changed(key):
+    """
+    Tells the RPC servers to forget what they have cached about the given app
+    key.  Postgres only delivers the notification if the current transaction
+    commits.
+    """
+    cursor = connection.cursor()
+    cursor.execute('SELECT pg_notify(%s, %s)', [APP_KEY_CHANNEL, key])
@@ -0,0 +1,184 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reading and writing archives of raw log rows that have been moved out of the
+database by the archive_logs management command.
+
+Archives are kept under a root directory as one gzipped file per table, app
+and day, at ``<root>/<table>/<app_id>/<YYYY-MM-DD>.json.gz``.  The first line
+of each file is a JSON list of the column names, and every following line is
+one row as a JSON list of values, so rows can be streamed in and out without
+holding a whole day in memory.  Files written by older versions hold a single
+JSON object with one list per column instead, and are still read.
+``<root>/<table>/index.json`` records the number of rows and the timestamp
+range of every file, so readers can skip files without opening them.
+
+Files are written to a temporary name, synced to disk and then renamed into
+place, so a crash never leaves a partly written archive behind.
+"""
+
+import calendar
+import contextlib
+import datetime
+import gzip
+import os
+
+import simplejson
+
+COLUMNS = ('uuid', 'timestamp', 'action', 'data', 'udid', 'api_version',
+    'app_version', 'bundle_version', 'app_key', 'platform')
+
+
+def _get_path(root, table, app_id, day):
+    return os.path.join(root, table, str(app_id), day + '.json.gz')
+
+
+@contextlib.contextmanager
+def _open(path, compress=False):
+    """
+    Opens a temporary file next to ``path`` for writing.  Once the block
+    finishes, the file is synced and renamed over ``path``, and the rename is
+    synced too.  If the block raises, the temporary file is removed and
+    ``path`` is left untouched.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + '.tmp'
+    f = open(tmp, 'wb')
+    try:
+        try:
+            if compress:
+                gz = gzip.GzipFile(fileobj=f, mode='wb')
+                try:
+                    yield gz
+                finally:
+                    gz.close()
+            else:
+                yield f
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+    except:
+        os.remove(tmp)
+        raise
+    os.rename(tmp, path)
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_json(path, obj):
+    with _open(path) as f:
+        simplejson.dump(obj, f)
+
+
+def get_day(ts):
+    return datetime.datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d')
+
+
+def load_index(root, table):
+    """
+    Returns a dictionary mapping app id (as a string) to a dictionary mapping
+    each archived day to its number of rows and timestamp range.
+    """
+    path = os.path.join(root, table, 'index.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        return simplejson.load(f)
+
+
+def iter_day(root, table, app_id, day):
+    """
+    Yields the rows archived for the given day as dictionaries mapping each
+    column name to its value.  Yields nothing if there is no archive.
+    """
+    path = _get_path(root, table, app_id, day)
+    if not os.path.exists(path):
+        return
+    f = gzip.open(path, 'rb')
+    try:
+        header = simplejson.loads(f.readline())
+        if isinstance(header, dict):
+            # Written before archives held one row per line.
+            for i in xrange(len(header['uuid'])):
+                yield dict(((c, header[c][i]) for c in COLUMNS))
+            return
+        for line in f:
+            yield dict(zip(header, simplejson.loads(line)))
+    finally:
+        f.close()
+
+
+def write_day(root, table, app_id, day, rows, index=None):
+    """
+    Adds rows, given as an iterable of value sequences in ``COLUMNS`` order,
+    to the archive for the given day, skipping any uuids that are already
+    archived.  The rows are streamed straight into the new file, and once
+    this returns they are safely on disk.  Updates ``index`` in place if it
+    is given; the caller is then responsible for saving it with
+    ``save_index``.
+    """
+    path = _get_path(root, table, app_id, day)
+    seen = set()
+    info = {'rows': 0, 'start': None, 'end': None}
+
+    def write(f, row):
+        f.write(simplejson.dumps(list(row)) + '\n')
+        ts = row[1]
+        info['rows'] += 1
+        info['start'] = ts if info['start'] is None else min(info['start'], ts)
+        info['end'] = ts if info['end'] is None else max(info['end'], ts)
+
+    with _open(path, compress=True) as f:
+        f.write(simplejson.dumps(COLUMNS) + '\n')
+        for log in iter_day(root, table, app_id, day):
+            seen.add(log['uuid'])
+            write(f, [log[c] for c in COLUMNS])
+        for row in rows:
+            if row[0] not in seen:
+                write(f, row)
+    if index is not None and info['rows']:
+        index.setdefault(str(app_id), {})[day] = info
+
+
+def save_index(root, table, index):
+    _write_json(os.path.join(root, table, 'index.json'), index)
+
+
+def iter_logs(root, table, app_id, start=None, end=None):
+    """
+    Yields the archived rows for the given app as dictionaries, in day order,
+    optionally limited to rows with ``start <= timestamp < end`` where both
+    are aware datetimes.
+    """
+    start_ts = start and calendar.timegm(start.utctimetuple())
+    end_ts = end and calendar.timegm(end.utctimetuple())
+    days = load_index(root, table).get(str(app_id), {})
+    for day, info in sorted(days.iteritems()):
+        if start_ts is not None and info['end'] < start_ts:
+            continue
+        if end_ts is not None and info['start'] >= end_ts:
+            continue
+        for log in iter_day(root, table, app_id, day):
+            if start_ts is not None and log['timestamp'] < start_ts:
+                continue
+            if end_ts is not None and log['timestamp'] >= end_ts:
+                continue
+            yield log
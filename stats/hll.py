@@ -0,0 +1,83 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HyperLogLog sketches for counting unique users.
+
+A sketch is a list of ``NUM_REGISTERS`` small integers.  Each udid is hashed to
+one register and a rank, and the register keeps the largest rank it has seen,
+so sketches for the same kind of bucket can be merged by taking the
+element-wise maximum.  With ``PRECISION = 12`` the standard error of
+``count`` is 1.04 / sqrt(4096), about 1.6%, regardless of how many users were
+added; roughly 95% of estimates fall within 3.3% of the true count.  Counts
+below about 10,000 use linear counting and are usually much closer than that.
+"""
+
+import hashlib
+import math
+
+PRECISION = 12
+NUM_REGISTERS = 1 << PRECISION
+ERROR = 1.04 / math.sqrt(NUM_REGISTERS)
+
+
+def get_register(value):
+    """
+    Returns the (index, rank) pair that adding ``value`` sets, where index is
+    zero-based.
+    """
+    h = long(hashlib.sha1(value).hexdigest()[:16], 16)
+    index = h >> (64 - PRECISION)
+    rest = h & ((1 << (64 - PRECISION)) - 1)
+    # The number of bits in rest, without int.bit_length from Python 2.7
+    bits = rest and len(bin(rest)) - 2
+    rank = (64 - PRECISION) - bits + 1
+    return index, rank
+
+
+def empty():
+    return [0] * NUM_REGISTERS
+
+
+def add(registers, value):
+    index, rank = get_register(value)
+    if rank > registers[index]:
+        registers[index] = rank
+    return registers
+
+
+def merge(*sketches):
+    """
+    Returns the union of the given sketches.  Missing (``None``) sketches are
+    treated as empty.
+    """
+    sketches = [s for s in sketches if s]
+    if not sketches:
+        return empty()
+    return map(max, *sketches) if len(sketches) > 1 else list(sketches[0])
+
+
+def count(registers):
+    """
+    Estimates the number of distinct values added to the given sketch.
+    """
+    if not registers:
+        return 0
+    m = float(len(registers))
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum([2.0 ** -r for r in registers])
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return int(round(estimate))
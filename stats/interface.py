@@ -14,17 +14,22 @@
 
 import datetime
 
+from django.conf import settings
 from django.db.models import F, Sum, Count
 from django.db import connections
 from django.utils.timezone import now
 
 from dashboard.models import App
 
+from stats import hll
+
 from stats.models import ViewDay
 from stats.models import ViewMonth, ViewYear
 from stats.models import UniqueDay, UniqueMonth
 from stats.models import UniqueAllTime
 
+UNIQUE_SKETCHES = getattr(settings, 'STATS_UNIQUE_SKETCHES', False)
+
 
 class Periods(object):
     TODAY = 1
@@ -108,6 +113,45 @@ def _unsparse(period, start, end, dct, pre=None):
     return dct
 
 
+def _get_sketches(app, period_name, start, end, platform=None,
+    new_only=False):
+    """
+    Returns a dictionary mapping each bucket timestamp in the given range to
+    the unique user sketch for that bucket, merged across platforms unless a
+    platform is given.
+    """
+    SQL = """
+    SELECT timestamp, %s
+    FROM stats_uniquesketch
+    WHERE
+        app_id = %%s AND
+        period = %%s AND
+        timestamp >= %%s AND
+        timestamp <= %%s
+        %s
+    """ % (
+        'new_registers' if new_only else 'registers',
+        '' if platform is None else 'AND platform = %s',
+    )
+    conn = _get_conn()
+    cursor = conn.cursor()
+    args = [_app_or_app_id(app), period_name, start, end]
+    if platform is not None:
+        args.append(platform)
+    cursor.execute(SQL, args)
+    sketches = {}
+    for timestamp, registers in cursor.fetchall():
+        sketches[timestamp] = hll.merge(sketches.get(timestamp), registers)
+    return sketches
+
+
+def _get_sketch_count(app, period, start, end, platform=None, new_only=False):
+    sketches = _get_sketches(app,
+        'day' if period == PERIODS.TODAY else 'month', start, end,
+        platform=platform, new_only=new_only)
+    return hll.count(hll.merge(*sketches.values()))
+
+
 def get_active_users(app, period, platform=None, new_only=False, prev=False):
     if period == PERIODS.ALLTIME and prev:
         return []
@@ -115,6 +159,13 @@ def get_active_users(app, period, platform=None, new_only=False, prev=False):
         start, end = PERIODS.get_prev_range(period)
     else:
         start, end = PERIODS.get_range(period)
+    if UNIQUE_SKETCHES:
+        sketches = _get_sketches(app,
+            'hour' if period == PERIODS.TODAY else 'day', start, end,
+            platform=platform, new_only=new_only)
+        dct = _unsparse(period, start, end, dict(((k, hll.count(v))
+            for k, v in sketches.iteritems())))
+        return [dict(timestamp=k, stat=dct[k]) for k in sorted(dct.iterkeys())]
     SQL = """
     SELECT
         timestamp,
@@ -264,6 +315,8 @@ def get_active_user_count(app, period, platform=None):
     app_id = _app_or_app_id(app)
 
     start, end = PERIODS.get_range(period)
+    if UNIQUE_SKETCHES and period != PERIODS.ALLTIME:
+        return _get_sketch_count(app, period, start, end, platform=platform)
     model = {
         PERIODS.TODAY: UniqueDay,
         PERIODS.MONTH: UniqueMonth,
@@ -300,6 +353,9 @@ def get_new_user_count(app, period, platform=None):
     app_id = _app_or_app_id(app)
 
     start, end = PERIODS.get_range(period)
+    if UNIQUE_SKETCHES and period != PERIODS.ALLTIME:
+        return _get_sketch_count(app, period, start, end, platform=platform,
+            new_only=True)
     model = {
         PERIODS.TODAY: UniqueDay,
         PERIODS.MONTH: UniqueMonth,
@@ -358,6 +414,9 @@ def get_view_count(app, period, platform=None):
 
 def get_current_monthly_user_count(app, platform=None):
     start, end = PERIODS.get_range(PERIODS.MONTH)
+    if UNIQUE_SKETCHES:
+        return _get_sketch_count(app, PERIODS.MONTH, start, end,
+            platform=platform)
     kwargs = dict(
         app_id=_app_or_app_id(app),
         timestamp__gte=start,
@@ -370,6 +429,20 @@ def get_current_monthly_user_count(app, platform=None):
 
 def get_current_monthly_user_counts():
     start, end = PERIODS.get_range(PERIODS.MONTH)
+    if UNIQUE_SKETCHES:
+        SQL = """
+        SELECT app_id, registers
+        FROM stats_uniquesketch
+        WHERE period = 'month' AND timestamp >= %s AND timestamp <= %s
+        """
+        conn = _get_conn()
+        cursor = conn.cursor()
+        cursor.execute(SQL, [start, end])
+        sketches = {}
+        for app_id, registers in cursor.fetchall():
+            sketches[app_id] = hll.merge(sketches.get(app_id), registers)
+        return dict(((app_id, hll.count(registers))
+            for app_id, registers in sketches.iteritems()))
     return dict(((um['app_id'], um['num']) for um in UniqueMonth.objects.filter(
         timestamp__gte=start,
         timestamp__lte=end
@@ -0,0 +1,112 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import datetime
+import itertools
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from dashboard.models import AppKey
+
+from stats import archive
+from stats.partitions import LOG_TABLES
+
+
+class Command(BaseCommand):
+    help = ('Moves raw log rows older than the given number of days out of '
+        'the database and into compressed per-app, per-day archive files.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=90,
+            help='Archive rows older than this many days'),
+        make_option('--dir', dest='root',
+            default=getattr(settings, 'CLUTCH_LOG_ARCHIVE_DIR', None),
+            help='Directory to write the archives to'),
+        make_option('--table', action='append', dest='tables',
+            help='Only archive this table (may be given more than once)'),
+    )
+
+    def handle(self, *args, **options):
+        if not options['root']:
+            raise CommandError('No archive directory was given, either set '
+                'CLUTCH_LOG_ARCHIVE_DIR or pass --dir')
+        app_ids = dict(AppKey.objects.values_list('key', 'app_id'))
+        cutoff = now().replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff = calendar.timegm(
+            (cutoff - datetime.timedelta(days=options['days'])).utctimetuple())
+        for table in options['tables'] or LOG_TABLES:
+            self.archive_table(table, cutoff, app_ids, options)
+
+    def archive_table(self, table, cutoff, app_ids, options):
+        cursor = connection.cursor()
+        cursor.execute('SELECT MIN(timestamp) FROM %s' % (table,))
+        start = cursor.fetchone()[0]
+        if start is None:
+            return
+        # Work through one day at a time, so that only a day's worth of rows
+        # is ever held in memory.
+        start = calendar.timegm(datetime.datetime.utcfromtimestamp(
+            start).date().timetuple())
+        index = archive.load_index(options['root'], table)
+        while start < cutoff:
+            with transaction.commit_on_success():
+                num = self.archive_day(table, start, app_ids, index, options)
+            if num:
+                self.stdout.write('Archived %s rows from %s for %s\n' % (
+                    num, table, archive.get_day(start)))
+            start += 24 * 60 * 60
+
+    def archive_day(self, table, start, app_ids, index, options):
+        # The archived rows are deleted by timestamp, which is only safe if
+        # the delete sees exactly the rows that were read, so both run under
+        # one snapshot.  The isolation level has to be set before the first
+        # query of the transaction, so end the one earlier reads left open.
+        transaction.commit()
+        cursor = connection.cursor()
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+
+        SQL = """
+        SELECT %s FROM %s
+        WHERE timestamp >= %%s AND timestamp < %%s
+        ORDER BY app_key
+        """ % (', '.join(archive.COLUMNS), table)
+        end = start + 24 * 60 * 60
+
+        # A named cursor keeps the rows on the server and streams them over
+        # in batches, and each app's rows are streamed straight into its
+        # archive file, so the day is never held in memory.
+        cursor = connection.connection.cursor('archive_%s' % (table,))
+        cursor.itersize = 2000
+        cursor.execute(SQL, [start, end])
+        day = archive.get_day(start)
+        for app_id, rows in itertools.groupby(cursor,
+            lambda row: app_ids.get(row[8], 0)):
+            archive.write_day(options['root'], table, app_id, day, rows,
+                index=index)
+        cursor.close()
+        archive.save_index(options['root'], table, index)
+
+        # Only delete once the archive files are safely on disk.  If we die
+        # before this commits, the next run archives the same rows again and
+        # write_day skips the ones it already has.
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE timestamp >= %%s AND '
+            'timestamp < %%s' % (table,), [start, end])
+        return cursor.rowcount
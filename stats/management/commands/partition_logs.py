@@ -0,0 +1,87 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from stats import partitions
+
+
+class Command(BaseCommand):
+    help = ('Creates the upcoming monthly partitions of the raw log tables '
+        'and removes the ones older than the retention window.  Meant to be '
+        'run from cron, at least once a month.  Rows in the parent table '
+        'for a partition\'s month are moved into it, which holds up inserts '
+        'into the parent table until it is done.  The trigger that routes '
+        'inserts into the parent table is only installed once '
+        'CLUTCH_LOG_PARTITIONS is set, so run this again after setting it.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--ahead', type='int', default=2,
+            help='Number of future months to create partitions for'),
+        make_option('--retention', type='int', default=None,
+            help='Number of past months of partitions to keep.  Older rows '
+                'still in the parent table are removed too.  Nothing is '
+                'removed unless this is given.'),
+        make_option('--detach', action='store_true', default=False,
+            help='Detach expired partitions instead of dropping them'),
+        make_option('--table', action='append', dest='tables',
+            help='Only manage this table (may be given more than once)'),
+    )
+
+    def handle(self, *args, **options):
+        tables = options['tables'] or partitions.LOG_TABLES
+        current = now().replace(day=1, hour=0, minute=0, second=0,
+            microsecond=0)
+        for table in tables:
+            with transaction.commit_on_success():
+                self.manage_table(table, current, options)
+
+    def manage_table(self, table, current, options):
+        cursor = connection.cursor()
+        for i in xrange(options['ahead'] + 1):
+            month = partitions.add_months(current, i)
+            if partitions.create_partition(cursor, table, month):
+                self.stdout.write('Created %s\n' % (
+                    partitions.get_partition_name(table, month),))
+        if getattr(settings, 'CLUTCH_LOG_PARTITIONS', False):
+            partitions.install_trigger(cursor, table)
+        else:
+            partitions.remove_trigger(cursor, table)
+
+        if options['retention'] is None:
+            return
+        cutoff = partitions.add_months(current, -options['retention'])
+        if options['detach']:
+            # Give the old rows in the parent table partitions of their own,
+            # so that they are detached along with the rest.
+            for month in partitions.get_parent_months(cursor, table, cutoff):
+                partitions.create_partition(cursor, table, month)
+        else:
+            deleted = partitions.delete_parent_rows(cursor, table, cutoff)
+            if deleted:
+                self.stdout.write('Deleted %d rows from %s\n' % (deleted,
+                    table))
+        existing = partitions.get_partitions(cursor, table)
+        for name, month in sorted(existing.iteritems()):
+            if month >= cutoff:
+                continue
+            partitions.remove_partition(cursor, table, name,
+                drop=not options['detach'])
+            self.stdout.write('%s %s\n' % (
+                'Detached' if options['detach'] else 'Dropped', name))
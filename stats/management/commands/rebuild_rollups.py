@@ -0,0 +1,420 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import calendar
+import datetime
+import multiprocessing
+import tempfile
+
+from collections import defaultdict
+from optparse import make_option
+from StringIO import StringIO
+
+import pytz
+import simplejson
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from dashboard.models import AppKey
+
+from stats import archive
+from stats import hll
+from stats.partitions import add_months
+
+DAY = 24 * 60 * 60
+
+LOG_SQL = """
+SELECT uuid, timestamp, udid, platform, data
+FROM stats_log
+WHERE
+    app_key IN %s AND
+    timestamp >= %s AND
+    timestamp < %s AND
+    action <> 'viewDidDisappear'
+"""
+
+FIRST_SEEN_SQL = """
+SELECT udid, platform, MIN(timestamp)
+FROM stats_log
+WHERE app_key IN %s AND timestamp < %s AND action <> 'viewDidDisappear'
+GROUP BY udid, platform
+HAVING MIN(timestamp) >= %s
+"""
+
+VIEW_COLUMNS = ('app_id', 'platform', 'timestamp', 'views')
+VIEW_SLUG_COLUMNS = ('app_id', 'platform', 'timestamp', 'slug', 'views')
+UNIQUE_COLUMNS = ('app_id', 'udid', 'platform', 'timestamp', 'new')
+SKETCH_COLUMNS = ('app_id', 'period', 'platform', 'timestamp', 'registers',
+    'new_registers')
+
+PERIODS = ('hour', 'day', 'month')
+
+# The users first seen in the month being rebuilt, mapped to the timestamp of
+# their first view.  Filled in by the parent before the worker processes for
+# the month are forked, so that the workers share it instead of having it
+# pickled over to them.
+FIRST_SEEN = {}
+
+
+def _get_hour(ts):
+    dt = datetime.datetime.utcfromtimestamp(ts).replace(tzinfo=pytz.utc)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _get_month(dt):
+    return dt.replace(day=1, hour=0)
+
+
+def _iter_logs(app_id, app_keys, start, root):
+    """
+    Yields (timestamp, udid, platform, slug) for each view in the day starting
+    at the given unix timestamp, from the database and from the archives.
+    The slug is None for legacy logs that were stored without one.
+    """
+    seen = set()
+    cursor = connection.cursor()
+    cursor.execute(LOG_SQL, [tuple(app_keys), start, start + DAY])
+    while 1:
+        rows = cursor.fetchmany(2000)
+        if not rows:
+            break
+        for uuid, ts, udid, platform, data in rows:
+            seen.add(uuid)
+            yield ts, udid, platform, simplejson.loads(data).get('slug')
+    if not root:
+        return
+    day = datetime.datetime.utcfromtimestamp(start).replace(tzinfo=pytz.utc)
+    for log in archive.iter_logs(root, 'stats_log', app_id, day,
+        day + datetime.timedelta(days=1)):
+        if log['uuid'] in seen or log['action'] == 'viewDidDisappear':
+            continue
+        yield (log['timestamp'], log['udid'], log['platform'],
+            simplejson.loads(log['data']).get('slug'))
+
+
+def _aggregate_day(args):
+    """
+    Computes the hour and day rollups for one day of one app's logs, along
+    with the number of logs skipped for having no slug.
+    """
+    app_id, app_keys, start, root = args
+    views = {'hour': defaultdict(int), 'day': defaultdict(int)}
+    slug_views = {'hour': defaultdict(int), 'day': defaultdict(int)}
+    uniques = {'hour': {}, 'day': {}}
+    skipped = 0
+    for ts, udid, platform, slug in _iter_logs(app_id, app_keys, start, root):
+        if slug is None:
+            skipped += 1
+            continue
+        hour = _get_hour(ts)
+        first = FIRST_SEEN.get((udid, platform))
+        first = first is not None and _get_hour(first)
+        for period, bucket in (('hour', hour), ('day', hour.replace(hour=0))):
+            new = bool(first) and (first == bucket if period == 'hour'
+                else first.replace(hour=0) == bucket)
+            views[period][(platform, bucket)] += 1
+            slug_views[period][(platform, bucket, slug)] += 1
+            key = (udid, platform, bucket)
+            uniques[period][key] = uniques[period].get(key, False) or new
+    return views, slug_views, uniques, skipped
+
+
+def _get_sketches(uniques):
+    """
+    Folds per-user uniques into a pair of registers, for all users and for
+    new users, per (platform, bucket).
+    """
+    sketches = {}
+    for (udid, platform, bucket), new in uniques.iteritems():
+        if (platform, bucket) not in sketches:
+            sketches[(platform, bucket)] = (hll.empty(), hll.empty())
+        registers, new_registers = sketches[(platform, bucket)]
+        hll.add(registers, udid)
+        if new:
+            hll.add(new_registers, udid)
+    return sketches
+
+
+def _copy_value(value):
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, list):
+        return '{%s}' % (','.join(map(str, value)),)
+    value = unicode(value).encode('utf-8')
+    for char, escaped in (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'),
+        ('\r', '\\r')):
+        value = value.replace(char, escaped)
+    return value
+
+
+def _write_rows(f, rows):
+    for row in rows:
+        f.write('\t'.join(map(_copy_value, row)) + '\n')
+
+
+def _copy_rows(cursor, table, columns, rows):
+    f = StringIO()
+    _write_rows(f, rows)
+    f.seek(0)
+    cursor.copy_from(f, table, columns=columns)
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the view and unique user rollups of one app for a '
+        'range of whole months from its raw logs, including any archived '
+        'logs, and swaps them into place in one transaction.  Year rollups '
+        'for the affected years are recomputed from the month rollups.  '
+        'Views logged for the range while the rebuild runs are lost, so only '
+        'rebuild ranges that are no longer receiving logs.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--app', type='int', dest='app_id',
+            help='Id of the app to rebuild'),
+        make_option('--start', help='First month to rebuild, as YYYY-MM'),
+        make_option('--end', help='Last month to rebuild, as YYYY-MM'),
+        make_option('--workers', type='int',
+            default=multiprocessing.cpu_count(),
+            help='Number of days to aggregate in parallel'),
+        make_option('--archive-dir', dest='root',
+            default=getattr(settings, 'CLUTCH_LOG_ARCHIVE_DIR', None),
+            help='Also read logs archived by archive_logs from here'),
+    )
+
+    def handle(self, *args, **options):
+        if not (options['app_id'] and options['start'] and options['end']):
+            raise CommandError('--app, --start and --end are required')
+        try:
+            start = datetime.datetime.strptime(options['start'], '%Y-%m')
+            end = datetime.datetime.strptime(options['end'], '%Y-%m')
+        except ValueError:
+            raise CommandError('--start and --end must look like YYYY-MM')
+        app_id = options['app_id']
+        start = start.replace(tzinfo=pytz.utc)
+        end = add_months(end.replace(tzinfo=pytz.utc), 1)
+
+        app_keys = list(AppKey.objects.filter(app=app_id).values_list('key',
+            flat=True))
+        if not app_keys:
+            raise CommandError('App %s has no keys' % (app_id,))
+
+        # The rollups are rebuilt one month at a time, and each month's rows
+        # are spooled to disk for COPY, so that only one month of uniques is
+        # ever held in memory.
+        sketches = getattr(settings, 'STATS_UNIQUE_SKETCHES', False)
+        self.spools = {}
+        skipped = 0
+        month = start
+        while month < end:
+            next_month = add_months(month, 1)
+            self.load_first_seen(app_id, app_keys, month, next_month,
+                options['root'])
+            # The workers open their own database connections, and must not
+            # inherit ours.
+            connection.close()
+            pool = multiprocessing.Pool(options['workers'])
+            days = [(app_id, app_keys, ts, options['root'])
+                for ts in xrange(calendar.timegm(month.utctimetuple()),
+                    calendar.timegm(next_month.utctimetuple()), DAY)]
+            views, slug_views, uniques, month_skipped = self.merge(
+                pool.imap_unordered(_aggregate_day, days))
+            pool.close()
+            pool.join()
+            self.spool_month(app_id, sketches, views, slug_views, uniques)
+            skipped += month_skipped
+            month = next_month
+        FIRST_SEEN.clear()
+
+        with transaction.commit_on_success():
+            self.swap(app_id, start, end, sketches)
+        for f, columns in self.spools.itervalues():
+            f.close()
+        if skipped:
+            self.stdout.write('Skipped %s logs without a slug\n' % (skipped,))
+        self.stdout.write('Rebuilt rollups for app %s from %s to %s\n' % (
+            app_id, start.date(), end.date()))
+
+    def load_first_seen(self, app_id, app_keys, start, end, root):
+        """
+        Fills in FIRST_SEEN with the users whose first view falls between the
+        given datetimes.  Users first seen earlier are never new in the month,
+        so they are left out.  Archived logs are all older than the logs in
+        the database.
+        """
+        FIRST_SEEN.clear()
+        cursor = connection.cursor()
+        cursor.execute(FIRST_SEEN_SQL, [tuple(app_keys),
+            calendar.timegm(end.utctimetuple()),
+            calendar.timegm(start.utctimetuple())])
+        while 1:
+            rows = cursor.fetchmany(2000)
+            if not rows:
+                break
+            for udid, platform, ts in rows:
+                FIRST_SEEN[(udid, platform)] = ts
+        if not root:
+            return
+        for log in archive.iter_logs(root, 'stats_log', app_id, start, end):
+            if log['action'] == 'viewDidDisappear':
+                continue
+            key = (log['udid'], log['platform'])
+            if key not in FIRST_SEEN or log['timestamp'] < FIRST_SEEN[key]:
+                FIRST_SEEN[key] = log['timestamp']
+        for log in archive.iter_logs(root, 'stats_log', app_id, end=start):
+            if log['action'] != 'viewDidDisappear':
+                FIRST_SEEN.pop((log['udid'], log['platform']), None)
+
+    def merge(self, results):
+        """
+        Combines the per-day results of one month, and rolls the day buckets
+        up into the month bucket.
+        """
+        views = dict(((p, defaultdict(int)) for p in PERIODS))
+        slug_views = dict(((p, defaultdict(int)) for p in PERIODS))
+        uniques = dict(((p, {}) for p in PERIODS))
+        skipped = 0
+        for day_views, day_slug_views, day_uniques, day_skipped in results:
+            for period in ('hour', 'day'):
+                for key, num in day_views[period].iteritems():
+                    views[period][key] += num
+                for key, num in day_slug_views[period].iteritems():
+                    slug_views[period][key] += num
+                uniques[period].update(day_uniques[period])
+            for (platform, bucket), num in day_views['day'].iteritems():
+                views['month'][(platform, _get_month(bucket))] += num
+            for (platform, bucket, slug), num in (
+                day_slug_views['day'].iteritems()):
+                slug_views['month'][(platform, _get_month(bucket), slug)] += num
+            for (udid, platform, bucket), new in day_uniques['day'].iteritems():
+                key = (udid, platform, _get_month(bucket))
+                uniques['month'][key] = uniques['month'].get(key) or new
+            skipped += day_skipped
+        return views, slug_views, uniques, skipped
+
+    def spool(self, table, columns, rows):
+        """
+        Appends rows to the temporary file that ``swap`` copies into the given
+        table.
+        """
+        if table not in self.spools:
+            self.spools[table] = (tempfile.TemporaryFile(), columns)
+        _write_rows(self.spools[table][0], rows)
+
+    def spool_month(self, app_id, sketches, views, slug_views, uniques):
+        for period in PERIODS:
+            self.spool('stats_view' + period, VIEW_COLUMNS,
+                ((app_id,) + k + (v,) for k, v in views[period].iteritems()))
+            self.spool('stats_viewslug' + period, VIEW_SLUG_COLUMNS,
+                ((app_id,) + k + (v,)
+                    for k, v in slug_views[period].iteritems()))
+            if sketches:
+                period_sketches = _get_sketches(uniques[period])
+                self.spool('stats_uniquesketch', SKETCH_COLUMNS,
+                    ((app_id, period) + k + v
+                        for k, v in period_sketches.iteritems()))
+            else:
+                self.spool('stats_unique' + period, UNIQUE_COLUMNS,
+                    ((app_id,) + k + (v,)
+                        for k, v in uniques[period].iteritems()))
+
+    def swap(self, app_id, start, end, sketches):
+        cursor = connection.cursor()
+        for period in PERIODS:
+            for table in ('stats_view', 'stats_viewslug', 'stats_unique'):
+                cursor.execute("""
+                DELETE FROM %s%s
+                WHERE app_id = %%s AND timestamp >= %%s AND timestamp < %%s
+                """ % (table, period), [app_id, start, end])
+        if sketches:
+            cursor.execute("""
+            DELETE FROM stats_uniquesketch
+            WHERE
+                app_id = %s AND
+                period IN ('hour', 'day', 'month') AND
+                timestamp >= %s AND
+                timestamp < %s
+            """, [app_id, start, end])
+        for table, (f, columns) in self.spools.iteritems():
+            f.seek(0)
+            cursor.copy_from(f, table, columns=columns)
+        self.swap_years(cursor, app_id, start, end, sketches)
+
+    def swap_years(self, cursor, app_id, start, end, sketches):
+        """
+        Recomputes the year rollups touched by the rebuilt range from the
+        month rollups, which by now hold the rebuilt months as well as any
+        months outside the range.
+        """
+        start = start.replace(month=1)
+        end = end if end.month == 1 else add_months(end.replace(month=1), 12)
+        args = [app_id, start, end]
+        cursor.execute("""
+        DELETE FROM stats_viewyear
+        WHERE app_id = %s AND timestamp >= %s AND timestamp < %s;
+        INSERT INTO stats_viewyear (app_id, platform, timestamp, views)
+        SELECT app_id, platform, date_trunc('year', timestamp), SUM(views)
+        FROM stats_viewmonth
+        WHERE app_id = %s AND timestamp >= %s AND timestamp < %s
+        GROUP BY app_id, platform, date_trunc('year', timestamp)
+        """, args * 2)
+        cursor.execute("""
+        DELETE FROM stats_viewslugyear
+        WHERE app_id = %s AND timestamp >= %s AND timestamp < %s;
+        INSERT INTO stats_viewslugyear (app_id, platform, timestamp, slug, views)
+        SELECT app_id, platform, date_trunc('year', timestamp), slug, SUM(views)
+        FROM stats_viewslugmonth
+        WHERE app_id = %s AND timestamp >= %s AND timestamp < %s
+        GROUP BY app_id, platform, date_trunc('year', timestamp), slug
+        """, args * 2)
+        if not sketches:
+            cursor.execute("""
+            DELETE FROM stats_uniqueyear
+            WHERE app_id = %s AND timestamp >= %s AND timestamp < %s;
+            INSERT INTO stats_uniqueyear (app_id, udid, platform, timestamp, new)
+            SELECT app_id, udid, platform, date_trunc('year', timestamp),
+                bool_or(new)
+            FROM stats_uniquemonth
+            WHERE app_id = %s AND timestamp >= %s AND timestamp < %s
+            GROUP BY app_id, udid, platform, date_trunc('year', timestamp)
+            """, args * 2)
+            return
+        cursor.execute("""
+        SELECT platform, date_trunc('year', timestamp), registers, new_registers
+        FROM stats_uniquesketch
+        WHERE
+            app_id = %s AND
+            period = 'month' AND
+            timestamp >= %s AND
+            timestamp < %s
+        """, args)
+        years = {}
+        for platform, year, registers, new_registers in cursor.fetchall():
+            current = years.get((platform, year), (None, None))
+            years[(platform, year)] = (hll.merge(current[0], registers),
+                hll.merge(current[1], new_registers))
+        cursor.execute("""
+        DELETE FROM stats_uniquesketch
+        WHERE
+            app_id = %s AND
+            period = 'year' AND
+            timestamp >= %s AND
+            timestamp < %s
+        """, args)
+        _copy_rows(cursor, 'stats_uniquesketch', SKETCH_COLUMNS,
+            [(app_id, 'year') + k + v for k, v in years.iteritems()])
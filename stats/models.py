@@ -218,6 +218,33 @@ class UniqueYear(models.Model):
             self.platform))
 
 
+class RegisterArrayField(models.Field):
+    """
+    Holds the registers of a HyperLogLog sketch (see ``stats.hll``) as a
+    native array, so that ingest can update single registers in place.
+    """
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'smallint[]'
+        return 'text'
+
+
+class UniqueSketch(models.Model):
+    app_id = models.IntegerField()
+    period = models.CharField(max_length=5)
+    timestamp = models.DateTimeField()
+    platform = models.CharField(max_length=12, default='iOS')
+    registers = RegisterArrayField()
+    new_registers = RegisterArrayField()
+
+    class Meta(object):
+        unique_together = (('app_id', 'period', 'timestamp', 'platform'),)
+
+    def __unicode__(self):
+        return str((self.app_id, self.period, self.timestamp, self.platform))
+
+
 class UniqueAllTime(models.Model):
     app_id = models.IntegerField()
     timestamp = models.DateTimeField(default=now)
@@ -0,0 +1,214 @@
+# Copyright 2012 Twitter
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Monthly partitioning of the raw log tables (``stats_log`` and ``ab_log``).
+
+Each month's logs live in a child table named like ``stats_log_p201210`` that
+inherits from the parent, with a CHECK constraint on its range of unix
+timestamps so that queries on a time range only scan the months they need.
+The ingest code in ``clutchrpc.db`` inserts into the child tables directly
+once CLUTCH_LOG_PARTITIONS is set.  Only then is a trigger installed on the
+parent to route any other inserts, because a routed insert reports no rows
+and the ingest code relies on ``RETURNING`` to tell which logs are new.  Rows
+for months with no partition stay in the parent table.
+
+Whenever the partitions are managed, any rows for their months that are in
+the parent table, such as those inserted before the setting was turned on, are
+moved into them, so that each month's rows end up in one place.  The ingest
+code relies on that to spot retried logs by looking in the partition alone.
+The move holds a lock that blocks inserts into the parent table, so the first
+run, which moves the current month's rows, is best done when traffic is low.
+Rows from earlier months stay in the parent table until they fall out of the
+retention window.
+"""
+
+import calendar
+import datetime
+import re
+
+import pytz
+
+LOG_TABLES = ('stats_log', 'ab_log')
+
+PARTITION_RE = re.compile(r'^(?P<table>\w+)_p(?P<year>\d{4})(?P<month>\d{2})$')
+
+
+def get_month(ts):
+    """
+    Returns the first instant of the month that the unix timestamp falls in.
+    """
+    dt = datetime.datetime.utcfromtimestamp(ts).replace(tzinfo=pytz.utc)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month, num):
+    index = month.year * 12 + month.month - 1 + num
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def get_partition_name(table, month):
+    return '%s_p%04d%02d' % (table, month.year, month.month)
+
+
+def get_partitions(cursor, table):
+    """
+    Returns a dictionary mapping the names of the partitions currently
+    attached to the given table to the month that each one holds.
+    """
+    SQL = """
+    SELECT C.relname
+    FROM pg_inherits I
+    JOIN pg_class C ON (C.oid = I.inhrelid)
+    JOIN pg_class P ON (P.oid = I.inhparent)
+    WHERE P.relname = %s
+    """
+    cursor.execute(SQL, [table])
+    partitions = {}
+    for (name,) in cursor.fetchall():
+        match = PARTITION_RE.match(name)
+        if match is None or match.group('table') != table:
+            continue
+        partitions[name] = datetime.datetime(int(match.group('year')),
+            int(match.group('month')), 1, tzinfo=pytz.utc)
+    return partitions
+
+
+def create_partition(cursor, table, month):
+    """
+    Creates the partition of the given table for the given month, along with
+    the same unique constraints that the parent has, and moves that month's
+    rows from the parent table into it, which is also done when it already
+    existed.  Returns False if it already existed.
+
+    Must be run in a transaction, which keeps inserts into the parent table
+    waiting until it commits, so that no row is left behind by the move.
+    """
+    name = get_partition_name(table, month)
+    cursor.execute('SELECT 1 FROM pg_class WHERE relname = %s', [name])
+    if cursor.fetchone():
+        move_parent_rows(cursor, table, month)
+        return False
+    fmt = _get_format(table, month)
+    cursor.execute("""
+    CREATE TABLE %(name)s (
+        CHECK (timestamp >= %(start)d AND timestamp < %(end)d)
+    ) INHERITS (%(table)s)
+    """ % fmt)
+    move_parent_rows(cursor, table, month)
+    cursor.execute('ALTER TABLE %s ADD PRIMARY KEY (uuid)' % (name,))
+    cursor.execute('ALTER TABLE %s ADD UNIQUE (timestamp, udid)' % (name,))
+    return True
+
+
+def _get_format(table, month):
+    return {
+        'name': get_partition_name(table, month),
+        'table': table,
+        'start': calendar.timegm(month.timetuple()),
+        'end': calendar.timegm(add_months(month, 1).timetuple()),
+    }
+
+
+def move_parent_rows(cursor, table, month):
+    """
+    Moves the given month's rows from the parent table into its existing
+    partition, skipping any that the partition already has, and returns how
+    many rows were taken out of the parent.  Must be run in a transaction.
+    """
+    fmt = _get_format(table, month)
+    cursor.execute('LOCK TABLE ONLY %(table)s IN SHARE ROW EXCLUSIVE MODE'
+        % fmt)
+    cursor.execute("""
+    INSERT INTO %(name)s
+    SELECT * FROM ONLY %(table)s P
+    WHERE P.timestamp >= %(start)d AND P.timestamp < %(end)d
+    AND NOT EXISTS (
+        SELECT 1 FROM %(name)s L
+        WHERE L.uuid = P.uuid OR
+            (L.timestamp = P.timestamp AND L.udid = P.udid)
+    )
+    """ % fmt)
+    cursor.execute("""
+    DELETE FROM ONLY %(table)s
+    WHERE timestamp >= %(start)d AND timestamp < %(end)d
+    """ % fmt)
+    return cursor.rowcount
+
+
+def get_parent_months(cursor, table, before):
+    """
+    Returns the months that rows older than the given month that are still in
+    the parent table belong to.
+    """
+    SQL = """
+    SELECT DISTINCT date_trunc('month',
+        to_timestamp(timestamp) AT TIME ZONE 'UTC')
+    FROM ONLY %s
+    WHERE timestamp < %%s
+    """ % (table,)
+    cursor.execute(SQL, [calendar.timegm(before.timetuple())])
+    return sorted(month.replace(tzinfo=pytz.utc)
+        for (month,) in cursor.fetchall())
+
+
+def delete_parent_rows(cursor, table, before):
+    """
+    Deletes the rows older than the given month that are still in the parent
+    table, and returns how many there were.
+    """
+    cursor.execute('DELETE FROM ONLY %s WHERE timestamp < %%s' % (table,),
+        [calendar.timegm(before.timetuple())])
+    return cursor.rowcount
+
+
+def install_trigger(cursor, table):
+    """
+    Installs a trigger on the parent table that moves inserted rows into the
+    partition for their month, leaving them in the parent if there isn't one.
+
+    Inserts that are moved report no rows, so this must only be done once the
+    ingest code inserts into the partitions itself.
+    """
+    cursor.execute("""
+    CREATE OR REPLACE FUNCTION %(table)s_route() RETURNS trigger AS $$
+    BEGIN
+        EXECUTE 'INSERT INTO ' || quote_ident('%(table)s_p' || to_char(
+            to_timestamp(NEW.timestamp) AT TIME ZONE 'UTC', 'YYYYMM'
+        )) || ' SELECT ($1).*' USING NEW;
+        RETURN NULL;
+    EXCEPTION WHEN undefined_table THEN
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """ % {'table': table})
+    remove_trigger(cursor, table)
+    cursor.execute("""
+    CREATE TRIGGER %(table)s_route BEFORE INSERT ON %(table)s
+    FOR EACH ROW EXECUTE PROCEDURE %(table)s_route()
+    """ % {'table': table})
+
+
+def remove_trigger(cursor, table):
+    cursor.execute('DROP TRIGGER IF EXISTS %s_route ON %s' % (table, table))
+
+
+def remove_partition(cursor, table, name, drop=True):
+    """
+    Detaches the named partition from the given table, so that its rows are
+    no longer visible through the parent, and drops it unless told not to.
+    """
+    cursor.execute('ALTER TABLE %s NO INHERIT %s' % (name, table))
+    if drop:
+        cursor.execute('DROP TABLE %s' % (name,))
@@ -19,8 +19,12 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import hashlib
+
 from django.test import TestCase
 
+from stats import hll
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -28,3 +32,29 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class HyperLogLogTest(TestCase):
+    def test_count_within_error(self):
+        registers = hll.empty()
+        for i in xrange(20000):
+            hll.add(registers, 'udid-%s' % (i,))
+        self.assertTrue(abs(hll.count(registers) - 20000) <=
+            20000 * hll.ERROR * 3)
+
+    def test_merge_is_union(self):
+        a, b = hll.empty(), hll.empty()
+        for i in xrange(1000):
+            hll.add(a, 'udid-%s' % (i,))
+            hll.add(b, 'udid-%s' % (i + 500,))
+        self.assertTrue(abs(hll.count(hll.merge(a, b)) - 1500) <=
+            1500 * hll.ERROR * 3)
+        self.assertEqual(hll.merge(a, None), a)
+
+    def test_rank(self):
+        for value in ('a', 'b', 'udid-1', 'udid-2'):
+            h = long(hashlib.sha1(value).hexdigest()[:16], 16)
+            rest = h & ((1 << (64 - hll.PRECISION)) - 1)
+            index, rank = hll.get_register(value)
+            self.assertEqual(index, h >> (64 - hll.PRECISION))
+            self.assertEqual(rest >> (64 - hll.PRECISION - rank), 1)